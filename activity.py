@@ -13,12 +13,11 @@
 import dbus
 import os
 import json
-import subprocess
+import shutil
 from time import sleep
 from ConfigParser import ConfigParser
 from gettext import gettext as _
 
-from gi.repository import Gio
 from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import GObject
@@ -56,6 +55,7 @@ from tasks import GET_CONNECTED_TASK
 from taskmaster import TaskMaster
 from graphics import Graphics, FONT_SIZES
 from helppanel import HelpPanel
+from volumestate import VolumeState
 import utils
 from power import get_power_manager
 
@@ -65,6 +65,9 @@ _logger = logging.getLogger('training-activity')
 
 _MINIMUM_SPACE = 1024 * 1024 * 10  # 10MB is very conservative
 _REQUIRED_SUGARSERVICES_VERSION = 5
+# USB keys slower than this to write and sync a small file are only
+# written at badges and on close (see TaskMaster.flush_to_usb).
+_SLOW_USB_LATENCY = 0.5  # seconds
 
 
 def _check_gconf_settings():
@@ -113,12 +116,6 @@ class TrainingActivity(activity.Activity):
         self.connect('completed', self.__transfer_completed_cb)
         self.connect('failed', self.__transfer_failed_cb)
 
-        self.volume_monitor = Gio.VolumeMonitor.get()
-        self._mount_added_id = self.volume_monitor.connect(
-            'mount-added', self._mount_added_cb)
-        self._mount_removed_id = self.volume_monitor.connect(
-            'mount-removed', self._mount_removed_cb)
-
         if hasattr(self, 'metadata') and 'font_size' in self.metadata:
             self.font_size = int(self.metadata['font_size'])
         else:
@@ -134,7 +131,10 @@ class TrainingActivity(activity.Activity):
 
         self.bundle_path = activity.get_bundle_path()
         self.volume_data = []
+        self._volume_data_ok = False
+        self.sugar_primary = False
         self._selected_volume = None
+        self._launched_volume = None
         self._saved_uid = None
         self._new_session = False
 
@@ -148,6 +148,13 @@ class TrainingActivity(activity.Activity):
         self._fatal_error = False
         self._notify_transfer_status = False
 
+        # The volume state is updated from mount events, so it must be
+        # connected before we listen for its changes.
+        self.volume_state = VolumeState(
+            os.path.join(self.get_activity_root(), 'data'))
+        self._volume_changed_id = self.volume_state.connect(
+            'changed', self._volume_changed_cb)
+
         if self.check_volume_data():
             if self.volume_data[0]['uid'] is not None:
                 GObject.idle_add(self._launcher)
@@ -155,6 +162,11 @@ class TrainingActivity(activity.Activity):
     def _launcher(self):
         get_power_manager().inhibit_suspend()
 
+        # Remember which training data we launched with so that we only
+        # relaunch when it changes.
+        self._launched_volume = (self.volume_data[0]['usb_path'],
+                                 self.volume_data[0]['uid'])
+
         # We are resuming the activity or we are launching a new instance?
         # * Is there a data file to sync on the USB key?
         # * Do we create a new data file on the USB key?
@@ -181,8 +193,34 @@ class TrainingActivity(activity.Activity):
         if hasattr(self, '_old_cursor'):
             self.get_window().set_cursor(self._old_cursor)
 
+    def check_volume_state(self):
+        ''' A cheap check, run before each task, that the volume data is
+            still valid: we only go back to check_volume_data if the last
+            check failed or a volume has gone away. '''
+        if not self._fatal_error and self._volume_data_ok and \
+           self.volume_state.is_alive():
+            self._check_training_files()
+            return True
+        return self.check_volume_data()
+
+    def _check_training_files(self):
+        ''' Rescan the USB key if the training-data file has been created
+            (e.g., by the first write of a new trainee) or removed since
+            the volume was last scanned. '''
+        if len(self.volume_data) != 1 or self.volume_data[0]['uid'] is None:
+            return
+        volume = self.volume_data[0]
+        path = os.path.join(volume['usb_path'], volume['uid'])
+        if os.path.exists(path) != (path in volume['files']):
+            self.volume_state.refresh(volume['usb_path'])
+            volume['files'] = self.volume_state.get_files(volume['usb_path'])
+
     def check_volume_data(self):
-        # Before we begin (and before each task),
+        self._volume_data_ok = self._check_volume_data()
+        return self._volume_data_ok
+
+    def _check_volume_data(self):
+        # Before we begin (and whenever the mounted volumes change),
         # we need to find any and all USB keys
         # and any and all training-data files on them.
 
@@ -192,16 +230,8 @@ class TrainingActivity(activity.Activity):
                           'so shutting down instead of checking volume data.')
             self.close()
 
-        _logger.debug(utils.get_volume_paths())
-        self.volume_data = []
-        for path in utils.get_volume_paths():
-            os.path.basename(path)
-            self.volume_data.append(
-                {'basename': os.path.basename(path),
-                 'files': utils.look_for_training_data(path),
-                 'sugar_path': os.path.join(self.get_activity_root(), 'data'),
-                 'usb_path': path})
-            _logger.debug(self.volume_data[-1])
+        self.volume_data = self.volume_state.get_volume_data()
+        _logger.debug(self.volume_data)
 
         # (1) We require a USB key
         if len(self.volume_data) == 0:
@@ -261,6 +291,8 @@ class TrainingActivity(activity.Activity):
             self._load_intro_graphics(message=alert.props.msg)
             return False
 
+        self._check_usb_latency(volume['usb_path'])
+
         # (5) Only one set of training data per USB key
         # We expect UIDs to formated as XXXX-XXXX.txt
         # We need to make sure we have proper UIDs associated with
@@ -281,7 +313,8 @@ class TrainingActivity(activity.Activity):
             _logger.debug('1 FILE FOUND')
             volume['uid'] = utils.check_volume_suffix(volume['files'][0])
             # In case we renamed the files, rescan
-            volume['files'] = utils.look_for_training_data(path)
+            self.volume_state.refresh(volume['usb_path'])
+            volume['files'] = self.volume_state.get_files(volume['usb_path'])
             _logger.debug(volume['files'])
             _logger.debug('Training data found. Using UID %s' %
                           volume['uid'])
@@ -308,8 +341,12 @@ class TrainingActivity(activity.Activity):
             email_list = []
             completed_list = []
             name_list = []
-            for file_name in volume['files']:
-                path = os.path.join(volume['usb_path'], file_name)
+            paths = [os.path.join(volume['usb_path'], file_name)
+                     for file_name in volume['files']]
+            # Read each file once (in parallel); the helpers below use
+            # the cached summaries.
+            utils.load_training_summaries(paths)
+            for path in paths:
                 email_list.append(utils.get_email_from_training_data(path))
                 completed_list.append(
                     utils.get_completed_from_training_data(path))
@@ -349,6 +386,21 @@ class TrainingActivity(activity.Activity):
             volume['uid'] = None
             return True
 
+    def _check_usb_latency(self, usb_path):
+        ''' Use the Sugar copy of the training data as the primary copy if
+            the USB key is slow to write. '''
+        latency = utils.measure_write_latency(usb_path)
+        if latency is None:
+            # Let write_task_data report any problems with the key.
+            self.sugar_primary = False
+            return
+        write_time, fsync_time = latency
+        self.sugar_primary = write_time + fsync_time > _SLOW_USB_LATENCY
+        _logger.error('USB %s write latency %.3fs fsync latency %.3fs: '
+                      'using %s mode' %
+                      (usb_path, write_time, fsync_time,
+                       'Sugar-primary' if self.sugar_primary else 'USB'))
+
     def _load_usb_selection_graphics(self, callback):
         center_in_panel = Gtk.Alignment.new(0.5, 0, 0, 0)
         graphics = Graphics()
@@ -432,7 +484,7 @@ class TrainingActivity(activity.Activity):
             data = {}
             data[TRAINING_DATA_UID] = self.volume_data[0]['uid']
             data[VERSION_NUMBER] = self.get_activity_version()
-            json_data = json.dumps(data)
+            json_data = utils.dump_training_data(data)
 
             write_failed = False
             usb_data_path = os.path.join(self.volume_data[0]['usb_path'],
@@ -492,162 +544,61 @@ class TrainingActivity(activity.Activity):
             self.close()
 
         if usb_data_path is not None:
-            usb_data = {}
-            if os.path.exists(usb_data_path):
-                fd = open(usb_data_path, 'r')
-                json_data = fd.read()
-                fd.close()
-                if len(json_data) > 0:
-                    try:
-                        usb_data = json.loads(json_data)
-                    except ValueError as e:
-                        _logger.error('Cannot load USB data: %s' % e)
-            else:
-                _logger.error('Cannot find USB data: %s' % usb_data_path)
-
             sugar_data_path = os.path.join(
                 self.volume_data[0]['sugar_path'],
                 self.volume_data[0]['uid'])
-            sugar_data = {}
-            if os.path.exists(sugar_data_path):
-                fd = open(sugar_data_path, 'r')
-                json_data = fd.read()
-                fd.close()
-                if len(json_data) > 0:
-                    try:
-                        sugar_data = json.loads(json_data)
-                    except ValueError as e:
-                        _logger.error('Cannot load Sugar data: %s' % e)
-            else:
-                _logger.error('Cannot find Sugar data: %s' % sugar_data_path)
-
-            # First, check to make sure email_address matches
-            if EMAIL_UID in usb_data:
-                usb_email = usb_data[EMAIL_UID]
-            else:
-                usb_email = None
-            if EMAIL_UID in sugar_data:
-                sugar_email = sugar_data[EMAIL_UID]
-            else:
-                sugar_email = None
-            if usb_email != sugar_email:
-                if usb_email is None and sugar_email is not None:
-                    _logger.warning('Using email address from Sugar: %s' %
-                                    sugar_email)
-                    usb_data[EMAIL_UID] = sugar_email
-                elif usb_email is not None and sugar_email is None:
-                    _logger.warning('Using email address from USB: %s' %
-                                    usb_email)
-                    sugar_data[EMAIL_UID] = usb_email
-                elif usb_email is None and sugar_email is None:
-                    _logger.warning('No email address found')
-                else:
-                    # FIX ME: We need to resolve this, but for right now, punt.
-                    alert = ConfirmationAlert()
-                    alert.props.title = _('Data mismatch')
-                    alert.props.msg = _('Are you %(usb)s or %(sugar)s?' %
-                                        {'usb': usb_email,
-                                         'sugar': sugar_email})
-                    alert.connect('response', self._close_alert_cb)
-                    self.add_alert(alert)
-                    self._load_intro_graphics(message=alert.props.msg)
-                    return False
-
-            def count_completed(data):
-                count = 0
-                for key in data:
-                    if isinstance(data[key], dict) and \
-                       'completed' in data[key] and \
-                       data[key]['completed']:
-                        count += 1
-                return count
-
-            # The database with the most completed tasks takes precedence.
-            if count_completed(usb_data) >= count_completed(sugar_data):
-                _logger.debug('data sync: USB data takes precedence')
-                data_one = usb_data
-                data_two = sugar_data
-            else:
-                _logger.debug('data sync: Sugar data takes precedence')
-                data_one = sugar_data
-                data_two = usb_data
-
-            # Copy completed tasks from one to two
-            for key in data_one:
-                if isinstance(data_one[key], dict) and \
-                   'completed' in data_one[key] and \
-                   data_one[key]['completed']:
-                    data_two[key] = data_one[key]
-
-            # Copy completed tasks from two to one
-            for key in data_two:
-                if isinstance(data_two[key], dict) and \
-                   'completed' in data_two[key] and \
-                   data_two[key]['completed']:
-                    data_one[key] = data_two[key]
-
-            # Copy incompleted tasks from one to two
-            for key in data_one:
-                if isinstance(data_one[key], dict) and \
-                   (not 'completed' in data_one[key] or
-                    not data_one[key]['completed']):
-                        data_two[key] = data_one[key]
-
-            # Copy incompleted tasks from two to one
-            for key in data_two:
-                if isinstance(data_two[key], dict) and \
-                   (not 'completed' in data_two[key] or
-                    not data_two[key]['completed']):
-                        data_one[key] = data_two[key]
-
-            # Copy name, email_address, current_task...
-            for key in data_one:
-                if not isinstance(data_one[key], dict):
-                    data_two[key] = data_one[key]
-            for key in data_two:
-                if not isinstance(data_two[key], dict):
-                    data_one[key] = data_two[key]
-
-            # Finally, write to the USB and ...
-            json_data = json.dumps(data_one)
-            try:
-                fd = open(usb_data_path, 'w')
-                fd.write(json_data)
-                fd.close()
-            except Exception, e:
-                self._fatal_error = True
-                _logger.error('Fatal error: could not write to %s: %s' %
-                              (usb_data_path, e))
+            return self.sync_data_done(
+                utils.sync_training_data(usb_data_path, sugar_data_path),
+                usb_data_path)
+        else:
+            _logger.error('No data to sync on USB')
+            return False
 
-                # Don't try remounting since we are going to close.
-                self.volume_monitor.disconnect(self._mount_added_id)
-                self.volume_monitor.disconnect(self._mount_removed_id)
+    def sync_data_done(self, result, usb_data_path):
+        ''' Report the result of utils.sync_training_data (which may have
+            been run in the background). Returns True if the data sets are
+            in sync. '''
+        status, details = result
+        if status == utils.SYNC_EMAIL_MISMATCH:
+            # FIX ME: We need to resolve this, but for right now, punt.
+            usb_email, sugar_email = details
+            alert = ConfirmationAlert()
+            alert.props.title = _('Data mismatch')
+            alert.props.msg = _('Are you %(usb)s or %(sugar)s?' %
+                                {'usb': usb_email,
+                                 'sugar': sugar_email})
+            alert.connect('response', self._close_alert_cb)
+            self.add_alert(alert)
+            self._load_intro_graphics(message=alert.props.msg)
+            return False
+        elif status == utils.SYNC_USB_WRITE_FAILED:
+            self._fatal_error = True
+            _logger.error('Fatal error: could not write to %s: %s' %
+                          (usb_data_path, details))
 
-                alert = ConfirmationAlert()
-                alert.props.title = _('USB key problem')
-                alert.props.msg = \
-                    _('We need to run a file check.')
-                alert.connect('response', self._dos_fsck_alert_cb)
-                self.add_alert(alert)
-                self._load_intro_graphics(file_name='fsck-usb.html')
-                return False
+            # Don't try remounting since we are going to close.
+            self.volume_state.disconnect(self._volume_changed_id)
+            self.volume_state.shutdown()
 
-            # ...save a shadow copy in Sugar
-            fd = open(sugar_data_path, 'w')
-            fd.write(json_data)
-            fd.close()
-            return True
-        else:
-            _logger.error('No data to sync on USB')
+            alert = ConfirmationAlert()
+            alert.props.title = _('USB key problem')
+            alert.props.msg = \
+                _('We need to run a file check.')
+            alert.connect('response', self._dos_fsck_alert_cb)
+            self.add_alert(alert)
+            self._load_intro_graphics(file_name='fsck-usb.html')
+            return False
+        elif status == utils.SYNC_READ_FAILED:
+            _logger.error('Could not sync data: %s' % details)
             return False
+        return True
 
     def _copy_data_from_USB(self):
         usb_path = self._check_for_USB_data()
         if usb_path is not None:
             try:
-                subprocess.call(['cp', usb_path,
-                                 self.volume_data[0]['sugar_path']])
-            except OSError as e:
+                shutil.copy(usb_path, self.volume_data[0]['sugar_path'])
+            except (IOError, OSError) as e:
                 _logger.error('Could not copy %s to %s: %s' % (
                     usb_path, self.volume_data[0]['sugar_path'], e))
         else:
@@ -698,6 +649,9 @@ class TrainingActivity(activity.Activity):
 
             self.favorites_count = len(utils.get_favorites())
 
+            # Load the Journal metadata the tasks will be polling
+            utils.get_journal_mirror()
+
             self._task_master = TaskMaster(self)
             self._task_master.show()
 
@@ -823,6 +777,7 @@ class TrainingActivity(activity.Activity):
 
     def write_file(self, file_path):
         # Only write if we have a valid USB/data file to work with.
+        self._check_training_files()
         if len(self.volume_data) == 1 and \
            len(self.volume_data[0]['files']) == 1:
             self.metadata[TRAINING_DATA_UID] = self.volume_data[0]['uid']
@@ -842,6 +797,9 @@ class TrainingActivity(activity.Activity):
                     name = ''
                 self.metadata[TRAINING_DATA_FULLNAME] = name
 
+        if hasattr(self, '_task_master'):
+            self._task_master.flush_to_usb()
+
         self.metadata['font_size'] = str(self.font_size)
 
     def update_activity_title(self):
@@ -1196,7 +1154,7 @@ class TrainingActivity(activity.Activity):
         sugar_icons = os.path.join(os.path.expanduser('~'), '.icons')
         if not os.path.exists(sugar_icons):
             try:
-                subprocess.call(['mkdir', sugar_icons])
+                os.makedirs(sugar_icons)
             except OSError as e:
                 _logger.error('Could not mkdir %s, %s' % (sugar_icons, e))
 
@@ -1211,8 +1169,8 @@ class TrainingActivity(activity.Activity):
         icon_dir = os.path.join(self.bundle_path, 'html-content', 'images')
         icon_path = os.path.join(icon_dir, icon + '.svg')
         try:
-            subprocess.call(['cp', icon_path, sugar_icons])
-        except OSError as e:
+            shutil.copy(icon_path, sugar_icons)
+        except (IOError, OSError) as e:
             _logger.error('Could not copy %s to %s, %s' %
                           (icon_path, sugar_icons, e))
 
@@ -1258,14 +1216,20 @@ class TrainingActivity(activity.Activity):
             except Exception as e:
                 _logger.error('Cannot reboot: %s' % e)
 
-    def _mount_added_cb(self, volume_monitor, device):
-        _logger.error('mount added')
-        if self.check_volume_data():
-            _logger.debug('launching')
-            self._launcher()
-
-    def _mount_removed_cb(self, volume_monitor, device):
-        _logger.error('mount removed')
-        if self.check_volume_data():
+    def _volume_changed_cb(self, volume_state):
+        _logger.error('mounted volumes changed')
+        if not self.check_volume_data():
+            self._launched_volume = None
+            return
+        volume = self.volume_data[0]
+        if volume['uid'] is None:
+            # Waiting for the user to select the training data
+            self._launched_volume = None
+        elif (volume['usb_path'], volume['uid']) == self._launched_volume:
+            _logger.debug('training data unchanged: not relaunching')
+            # Maybe the USB key has come back after a failed write
+            if hasattr(self, '_task_master'):
+                self._task_master.queue_resync()
+        else:
             _logger.debug('launching')
             self._launcher()
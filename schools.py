@@ -0,0 +1,559 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014, Sugarlabs
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+import os
+import sys
+import re
+import math
+import mmap
+import time
+import zlib
+import bisect
+import struct
+import argparse
+import threading
+from array import array
+
+import logging
+_logger = logging.getLogger('training-activity-schools')
+
+# sf_id, name, campus, address, city, state, postal_code
+_NUMBER_OF_FIELDS = 7
+_DEFAULT_SCHOOL_NAME = 'One Education School'
+_DEFAULT_SF_ID = '0019000000pETbT'
+
+# Salesforce ids are 15 (or 18) characters
+_SF_ID = re.compile(r'^[A-Za-z0-9]{15}([A-Za-z0-9]{3})?$')
+_MAX_POSTAL_CODE = 9999
+
+# The compiled index is a header, a table of the postal codes (sorted), a
+# table of record offsets, the records (sf_id\tlabel\tstate) sorted by
+# postal code, then a table of the records sorted by label, a table of key
+# offsets and the lowercase labels (keys) in the same order.
+_MAGIC = 'TSCH'
+_VERSION = 2
+# magic, version, number of schools, size and crc32 of schools.txt, index
+# of the default school (or -1)
+_HEADER = struct.Struct('<4sHIIIi')
+_UINT32 = struct.Struct('<I')
+
+# How far from a postal code do we look for nearby schools?
+_NEARBY_DISTANCE = 5
+
+# Fuzzy search is run on every key press, so it has a hard time budget.
+_SEARCH_BUDGET = 0.02  # seconds
+# Trigrams found in more than this fraction of the schools (e.g., 'sch')
+# tell us nothing and are skipped.
+_COMMON_TRIGRAM = 0.1
+# How many tokens can a partial (last) word expand to?
+_MAX_PREFIX_TOKENS = 50
+# Minimum fraction of a word's trigrams needed for a typo match
+_MIN_TRIGRAM_MATCH = 0.4
+_PREFIX_MATCH = 0.9
+_TRIGRAM_MATCH = 0.8
+
+_schools_index = None
+
+
+def get_schools_index(schools_path, index_path=None, prebuilt_path=None):
+    ''' Return the schools index, only rebuilding it if schools.txt has
+        changed since it was last built. A prebuilt index (see main) is
+        used if it was compiled from this schools.txt. '''
+    global _schools_index
+    if _schools_index is None or not _schools_index.is_current(schools_path):
+        _schools_index = SchoolsIndex(schools_path, index_path, prebuilt_path)
+    return _schools_index
+
+
+def _get_stamp(path):
+    try:
+        stats = os.stat(path)
+    except OSError as e:
+        _logger.error('Could not stat %s: %s' % (path, e))
+        return None
+    return (stats.st_mtime, stats.st_size)
+
+
+def _get_checksum(data):
+    return (len(data), zlib.crc32(data) & 0xffffffff)
+
+
+def parse_schools(data):
+    ''' Parse the contents of schools.txt into a list of
+        (postal_code, sf_id, label, state) and the sf_id of the default
+        school. Also returns lists of (line number, message) for the errors
+        (the line is skipped) and warnings found. '''
+    schools = []
+    default_sf_id = None
+    errors = []
+    warnings = []
+    sf_ids = {}
+    labels = {}
+    for i, line in enumerate(data.split('\n')):
+        line = line.rstrip('\r')
+        if len(line.strip()) == 0:
+            continue
+        fields = line.split(',')
+        if len(fields) != _NUMBER_OF_FIELDS:
+            errors.append((i + 1, 'expected %d fields, found %d' %
+                           (_NUMBER_OF_FIELDS, len(fields))))
+            continue
+        sf_id, name, campus, address, city, state, postal_code = fields
+        if _SF_ID.match(sf_id) is None:
+            errors.append((i + 1, 'bad sf_id %r' % sf_id))
+            continue
+        try:
+            postal_code = int(postal_code)
+        except ValueError:
+            errors.append((i + 1, 'bad postal code %r' % postal_code))
+            continue
+        if postal_code < 0 or postal_code > _MAX_POSTAL_CODE:
+            errors.append((i + 1, 'bad postal code %r' % fields[-1]))
+            continue
+        if sf_id in sf_ids:
+            errors.append((i + 1, 'duplicate sf_id %s (line %d)' %
+                           (sf_id, sf_ids[sf_id])))
+            continue
+        sf_ids[sf_id] = i + 1
+
+        label = get_school_label(name, campus, city, state)
+        if (label, postal_code) in labels:
+            warnings.append((i + 1, 'duplicate school %s %d (line %d)' %
+                             (label, postal_code,
+                              labels[(label, postal_code)])))
+        else:
+            labels[(label, postal_code)] = i + 1
+
+        # save the SF_ID from One Education in case we need it
+        if name == _DEFAULT_SCHOOL_NAME:
+            default_sf_id = sf_id
+        schools.append((postal_code, sf_id, label.replace('\t', ' '), state))
+    return schools, default_sf_id, errors, warnings
+
+
+def compile_schools(data, schools, default_sf_id=None):
+    ''' Compile the parsed schools (see parse_schools) from the contents
+        of schools.txt into the binary index read by SchoolsIndex '''
+    # Python's sort is stable, so schools keep their order in the file.
+    schools = sorted(schools, key=lambda school: school[0])
+    default = -1
+    postal_codes = []
+    offsets = [0]
+    records = []
+    for i, (postal_code, sf_id, label, state) in enumerate(schools):
+        if sf_id == default_sf_id:
+            default = i
+        record = '%s\t%s\t%s' % (sf_id, label, state)
+        postal_codes.append(_UINT32.pack(postal_code))
+        records.append(record)
+        offsets.append(offsets[-1] + len(record))
+
+    # For prefix completion and looking up schools by label
+    by_label = sorted(range(len(schools)),
+                      key=lambda i: schools[i][2].lower())
+    key_offsets = [0]
+    keys = []
+    for i in by_label:
+        key = schools[i][2].lower()
+        keys.append(key)
+        key_offsets.append(key_offsets[-1] + len(key))
+
+    size, checksum = _get_checksum(data)
+    return ''.join([_HEADER.pack(_MAGIC, _VERSION, len(schools), size,
+                                 checksum, default)] +
+                   postal_codes +
+                   [_UINT32.pack(offset) for offset in offsets] +
+                   records +
+                   [_UINT32.pack(i) for i in by_label] +
+                   [_UINT32.pack(offset) for offset in key_offsets] +
+                   keys)
+
+
+def write_index(index, index_path):
+    ''' Replace the index file in one step so it is never seen half
+        written '''
+    tmp_path = index_path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as fd:
+            fd.write(index)
+        os.rename(tmp_path, index_path)
+    except (IOError, OSError) as e:
+        _logger.error('Could not save %s: %s' % (index_path, e))
+        return False
+    return True
+
+
+def _get_tokens(text):
+    ''' Lowercase words, ignoring apostrophes (St Mary's == St Marys) '''
+    return re.sub(r'[^a-z0-9]+', ' ',
+                  text.lower().replace("'", '')).split()
+
+
+def _get_trigrams(token):
+    padded = '$%s$' % token
+    return set([padded[i:i + 3] for i in range(len(padded) - 2)])
+
+
+def get_school_label(name, campus, city, state):
+    ''' The school as presented to (and entered by) the user '''
+    if len(campus) > 0:
+        return '%s %s, %s, %s' % (name, campus, city, state)
+    else:
+        return '%s, %s, %s' % (name, city, state)
+
+
+class _Table(object):
+    ''' A read-only uint32 array in the index, indexed in place (e.g., by
+        bisect) without decoding the whole table '''
+
+    def __init__(self, buffer, offset, length):
+        self._buffer = buffer
+        self._offset = offset
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, i):
+        if i < 0 or i >= self._length:
+            raise IndexError(i)
+        return _UINT32.unpack_from(self._buffer, self._offset + 4 * i)[0]
+
+
+class _Strings(object):
+    ''' A read-only array of strings in the index, indexed in place (e.g.,
+        by bisect) through a table of offsets '''
+
+    def __init__(self, buffer, offset, offsets):
+        self._buffer = buffer
+        self._offset = offset
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0 or i >= len(self):
+            raise IndexError(i)
+        return self._buffer[self._offset + self._offsets[i]:
+                            self._offset + self._offsets[i + 1]]
+
+
+class SchoolsIndex(object):
+    ''' The schools in schools.txt, compiled into a compact file sorted by
+        postal code. The file is memory mapped and only the schools that
+        are returned are decoded, so looking up the schools for a postal
+        code is a bisect of the postal code table. '''
+
+    def __init__(self, schools_path, index_path=None, prebuilt_path=None):
+        self._schools_path = schools_path
+        self._stamp = _get_stamp(schools_path)
+        self._buffer = None
+        self._search_index = None
+        self._search_index_lock = threading.Lock()
+        self.default_sf_id = _DEFAULT_SF_ID
+
+        try:
+            with open(schools_path, 'rb') as fd:
+                data = fd.read()
+        except IOError as e:
+            _logger.error('Could not read %s: %s' % (schools_path, e))
+            data = None
+
+        checksum = None if data is None else _get_checksum(data)
+        for path in [prebuilt_path, index_path]:
+            if path is not None and self._open(path, checksum):
+                return
+        if data is None:
+            data = ''
+
+        # Run main() on schools.txt for the details.
+        schools, default_sf_id, errors, warnings = parse_schools(data)
+        if len(errors) > 0:
+            _logger.error('%d lines of bad school data in %s' %
+                          (len(errors), schools_path))
+        index = compile_schools(data, schools, default_sf_id)
+        if index_path is None or not write_index(index, index_path) or \
+           not self._open(index_path, None):
+            # Fall back to reading the index from memory
+            self._set_buffer(index)
+
+    def _open(self, index_path, checksum):
+        ''' Map a compiled index, if it is valid and was compiled from the
+            schools.txt with this checksum '''
+        if not os.path.exists(index_path):
+            return False
+        try:
+            with open(index_path, 'rb') as fd:
+                buffer = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError) as e:
+            _logger.error('Could not map %s: %s' % (index_path, e))
+            return False
+        if not self._set_buffer(buffer, checksum):
+            buffer.close()
+            return False
+        return True
+
+    def _set_buffer(self, buffer, checksum=None):
+        if len(buffer) < _HEADER.size:
+            return False
+        magic, version, count, size, crc, default = \
+            _HEADER.unpack_from(buffer, 0)
+        if magic != _MAGIC or version != _VERSION:
+            return False
+        if checksum is not None and checksum != (size, crc):
+            return False
+        offsets_offset = _HEADER.size + 4 * count
+        records_offset = offsets_offset + 4 * (count + 1)
+        if len(buffer) < records_offset:
+            return False
+        offsets = _Table(buffer, offsets_offset, count + 1)
+        by_label_offset = records_offset + offsets[count]
+        key_offsets_offset = by_label_offset + 4 * count
+        keys_offset = key_offsets_offset + 4 * (count + 1)
+        if len(buffer) < keys_offset:
+            return False
+        key_offsets = _Table(buffer, key_offsets_offset, count + 1)
+        if len(buffer) != keys_offset + key_offsets[count]:
+            return False
+
+        self._buffer = buffer
+        self._count = count
+        self._postal_codes = _Table(buffer, _HEADER.size, count)
+        self._offsets = offsets
+        self._records_offset = records_offset
+        self._by_label = _Table(buffer, by_label_offset, count)
+        self._keys = _Strings(buffer, keys_offset, key_offsets)
+        if default >= 0:
+            self.default_sf_id = self._get_record(default)[0]
+        return True
+
+    def _get_record(self, i):
+        ''' Decode one school: (sf_id, label, state) '''
+        start = self._records_offset + self._offsets[i]
+        end = self._records_offset + self._offsets[i + 1]
+        return tuple(self._buffer[start:end].split('\t'))
+
+    def _get_records(self):
+        for i in range(self._count):
+            yield self._get_record(i)
+
+    def is_current(self, schools_path):
+        return schools_path == self._schools_path and \
+            _get_stamp(schools_path) == self._stamp
+
+    def lookup(self, postal_code):
+        ''' Return a list of (label, sf_id) for a postal code '''
+        start = bisect.bisect_left(self._postal_codes, postal_code)
+        end = bisect.bisect_right(self._postal_codes, postal_code, start)
+        schools = []
+        for i in range(start, end):
+            sf_id, label, state = self._get_record(i)
+            schools.append((label, sf_id))
+        return schools
+
+    def lookup_nearby(self, postal_code, distance=_NEARBY_DISTANCE,
+                      same_state=True):
+        ''' Return a list of (label, sf_id) for the schools within distance
+            of a postal code, nearest first. With same_state, only schools
+            in the same state as the nearest school are returned (postal
+            codes on either side of a state border can be close). '''
+        start = bisect.bisect_left(self._postal_codes, postal_code - distance)
+        end = bisect.bisect_right(self._postal_codes, postal_code + distance,
+                                  start)
+        # sorted is stable, so ties stay in postal code order
+        nearby = sorted(range(start, end), key=lambda i:
+                        abs(self._postal_codes[i] - postal_code))
+        schools = []
+        state = None
+        for i in nearby:
+            sf_id, label, school_state = self._get_record(i)
+            if state is None:
+                state = school_state
+            elif same_state and school_state != state:
+                continue
+            schools.append((label, sf_id))
+        return schools
+
+    def complete(self, text, limit=None):
+        ''' Return the labels of the schools that start with text (ignoring
+            case), in order. Only the labels returned are decoded. '''
+        prefix = text.lower()
+        i = bisect.bisect_left(self._keys, prefix)
+        labels = []
+        while i < self._count and (limit is None or len(labels) < limit) \
+                and self._keys[i].startswith(prefix):
+            labels.append(self._get_record(self._by_label[i])[1])
+            i += 1
+        return labels
+
+    def get_sf_id(self, label):
+        ''' Return the sf_id for a school label (or None) '''
+        key = label.lower()
+        i = bisect.bisect_left(self._keys, key)
+        found = None
+        # The same school may be listed under more than one postal code:
+        # use the last one (by postal code).
+        while i < self._count and self._keys[i] == key:
+            sf_id, school_label, state = self._get_record(self._by_label[i])
+            if school_label == label:
+                found = sf_id
+            i += 1
+        return found
+
+    def search(self, text, limit=10, budget=_SEARCH_BUDGET):
+        ''' Typo-tolerant search over the school names, campuses and cities.
+            Each word typed is matched against whole words, then (for the
+            last, partial, word) prefixes and finally shared trigrams; rare
+            words count more than common ones. Returns the labels of the
+            best matches found within the time budget, or nothing until the
+            search index has been built (see build_search_index). '''
+        query = _get_tokens(text)
+        search_index = self._search_index
+        if len(query) == 0 or search_index is None:
+            return []
+        tokens, postings, trigrams = search_index
+        deadline = time.time() + budget
+        number_of_schools = self._count
+
+        scores = {}
+        for i, word in enumerate(query):
+            # Best match for this word in each school
+            matches = {}
+            if word in postings:
+                for school in postings[word]:
+                    matches[school] = 1.0
+                weight = math.log(1 + number_of_schools /
+                                  float(len(postings[word])))
+            else:
+                weight = math.log(1 + number_of_schools)
+
+            if i == len(query) - 1:
+                j = bisect.bisect_left(tokens, word)
+                for token in tokens[j:j + _MAX_PREFIX_TOKENS]:
+                    if not token.startswith(word):
+                        break
+                    for school in postings[token]:
+                        if matches.get(school, 0) < _PREFIX_MATCH:
+                            matches[school] = _PREFIX_MATCH
+                    if time.time() > deadline:
+                        break
+
+            word_trigrams = [trigram for trigram in _get_trigrams(word)
+                             if trigram in trigrams and
+                             len(trigrams[trigram]) <
+                             number_of_schools * _COMMON_TRIGRAM]
+            counts = {}
+            for trigram in word_trigrams:
+                for school in trigrams[trigram]:
+                    counts[school] = counts.get(school, 0) + 1
+                if time.time() > deadline:
+                    break
+            for school, count in counts.items():
+                fraction = count / float(len(word_trigrams))
+                if fraction >= _MIN_TRIGRAM_MATCH and \
+                   matches.get(school, 0) < fraction * _TRIGRAM_MATCH:
+                    matches[school] = fraction * _TRIGRAM_MATCH
+
+            for school, match in matches.items():
+                scores[school] = scores.get(school, 0) + match * weight
+
+            if time.time() > deadline:
+                _logger.debug('school search for %s ran out of time' % text)
+                break
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [self._get_record(school)[1]
+                for school, score in ranked[:limit]]
+
+    def build_search_index(self):
+        ''' Build the inverted word and trigram indexes used by search. It
+            takes a while, so call it from a worker thread before the
+            search is needed. The postings are sorted arrays of school
+            numbers. '''
+        with self._search_index_lock:
+            if self._search_index is not None:
+                return
+            start_time = time.time()
+            postings = {}
+            trigrams = {}
+            for school, (sf_id, label, state) in \
+                    enumerate(self._get_records()):
+                # The label is name [campus], city, state: skip the state
+                for token in set(_get_tokens(label.rsplit(',', 1)[0])):
+                    if not token in postings:
+                        postings[token] = array('I')
+                    postings[token].append(school)
+                    for trigram in _get_trigrams(token):
+                        if not trigram in trigrams:
+                            trigrams[trigram] = array('I')
+                        # Schools are added in order, so only the last one
+                        # can be a duplicate.
+                        school_trigrams = trigrams[trigram]
+                        if len(school_trigrams) == 0 or \
+                           school_trigrams[-1] != school:
+                            school_trigrams.append(school)
+
+            self._search_index = (sorted(postings.keys()), postings,
+                                  trigrams)
+            _logger.debug('built school search index in %.3fs' %
+                          (time.time() - start_time))
+
+
+def main():
+    ''' Check schools.txt and compile it into the index read by the
+        activity, e.g., python schools.py schools.txt schools.bin '''
+    parser = argparse.ArgumentParser(
+        description='Check the schools data and compile it into the index '
+        'used by the activity.')
+    parser.add_argument('schools', help='schools data, e.g., schools.txt')
+    parser.add_argument('index', nargs='?',
+                        help='compiled index (default: schools.bin next to '
+                        'the schools data)')
+    args = parser.parse_args()
+    if args.index is None:
+        args.index = os.path.join(os.path.dirname(args.schools),
+                                  'schools.bin')
+
+    start_time = time.time()
+    try:
+        with open(args.schools, 'rb') as fd:
+            data = fd.read()
+    except IOError as e:
+        print 'Could not read %s: %s' % (args.schools, e)
+        return 2
+
+    schools, default_sf_id, errors, warnings = parse_schools(data)
+    for line_number, message in errors:
+        print '%s:%d: error: %s' % (args.schools, line_number, message)
+    for line_number, message in warnings:
+        print '%s:%d: warning: %s' % (args.schools, line_number, message)
+    if default_sf_id is None:
+        print '%s: warning: no %s (using %s)' % \
+            (args.schools, _DEFAULT_SCHOOL_NAME, _DEFAULT_SF_ID)
+
+    index = compile_schools(data, schools, default_sf_id)
+    if not write_index(index, args.index):
+        print 'Could not write %s' % args.index
+        return 2
+
+    print '%d schools (%d postal codes), %d errors, %d warnings' % \
+        (len(schools), len(set([school[0] for school in schools])),
+         len(errors), len(warnings))
+    print 'Wrote %s (%d bytes) in %.2f seconds' % \
+        (args.index, len(index), time.time() - start_time)
+    return 1 if len(errors) > 0 else 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    sys.exit(main())
@@ -11,7 +11,7 @@
 # Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
 
 import os
-import json
+import copy
 import time
 from gettext import gettext as _
 
@@ -25,6 +25,12 @@ from sugar3.graphics.toolbutton import ToolButton
 import logging
 _logger = logging.getLogger('training-activity-taskmaster')
 
+# Wait for things to settle down (e.g., after a failed write or a mount
+# event) before resyncing the USB and Sugar copies of the training data.
+_RESYNC_DELAY = 2000  # ms
+# Back off to this after failed resyncs, e.g., while the USB key is bad
+_MAX_RESYNC_DELAY = 30000  # ms
+
 import tasks
 from progressbar import ProgressBar
 import utils
@@ -67,6 +73,15 @@ class TaskMaster(Gtk.Alignment):
         self._task_data = None
         self._sugar_data_path = None
         self._resync_required = False
+        self._resync_failures = 0
+        self._resync_timeout_id = None
+        self._resync_result = None
+        # Writes made while a resync is running (see write_task_data)
+        self._pending_writes = []
+        self._usb_dirty = False
+        self._data_cache = None
+        # The data last read or written, even if it is not cached
+        self._last_data = None
         self._uid = None
         self._start_time = time.time()
         self._accumulated_time = 0
@@ -172,7 +187,7 @@ class TaskMaster(Gtk.Alignment):
         ''' 'nough said. '''
 
         # Recheck USB status each time
-        if not self.activity.check_volume_data():
+        if not self.activity.check_volume_state():
             _logger.error('Check volume data failed')
             # return
 
@@ -642,169 +657,365 @@ class TaskMaster(Gtk.Alignment):
                     count += 1
         return count
 
-    def read_task_data(self, uid=None):
-        usb_data_path = None
-        sugar_data_path = self._sugar_data_path
-        uid_data = None
-        usb_read_failed = False
-        data = {}
-
+    def _get_data_paths(self):
+        ''' The training data on the USB key and the shadow copy in Sugar '''
         if len(self.activity.volume_data) == 0:
-            _logger.error('No USB device found... trying to read from Sugar.')
-            usb_read_failed = True
+            return None, self._sugar_data_path
+        return (os.path.join(self.activity.volume_data[0]['usb_path'],
+                             self.activity.volume_data[0]['uid']),
+                os.path.join(self.activity.volume_data[0]['sugar_path'],
+                             self.activity.volume_data[0]['uid']))
+
+    def _read_training_data(self, path):
+        ''' Returns the training data and its generation, or None '''
+        try:
+            fd = open(path, 'r')
+            json_data = fd.read()
+            fd.close()
+        except Exception, e:
+            # Maybe USB key has been pulled?
+            _logger.error('Could not read from %s: %s' % (path, e))
+            return None
+        if len(json_data) == 0:
+            return {}, None
+        try:
+            return (utils.load_training_data(json_data),
+                    utils.get_training_generation(json_data))
+        except ValueError, e:
+            _logger.error('Cannot load training data: %s' % e)
+            return None
+
+    def _is_shadow_copy_current(self, usb_data_path, sugar_data_path):
+        ''' Is the (faster) shadow copy in Sugar the same as the copy on the
+            USB key? Only the summaries at the start of the files are
+            read. '''
+        if sugar_data_path is None or not os.path.exists(sugar_data_path):
+            return False
+        usb_stamp = utils.get_file_stamp(usb_data_path)
+        sugar_stamp = utils.get_file_stamp(sugar_data_path)
+        if usb_stamp is None or sugar_stamp is None or \
+           usb_stamp[1] != sugar_stamp[1]:
+            return False
+        generation = utils.load_training_summary(usb_data_path)['generation']
+        return generation is not None and generation == \
+            utils.load_training_summary(sugar_data_path)['generation']
+
+    def _get_cached_data(self, usb_data_path, sugar_data_path, sugar_primary):
+        ''' Return the training data we last read or wrote, unless the copy
+            on the USB key has changed since then (or None). '''
+        cache = self._data_cache
+        if cache is None or cache['usb_path'] != usb_data_path or \
+           cache['sugar_path'] != sugar_data_path:
+            return None
+        if usb_data_path is None or sugar_primary:
+            return cache['data']
+        stamp = utils.get_file_stamp(usb_data_path)
+        if stamp is None:
+            # Maybe USB key has been pulled? Carry on with the data we
+            # have: the next write will ask for a resync.
+            return cache['data']
+        if stamp != cache['stamp']:
+            generation = \
+                utils.load_training_summary(usb_data_path)['generation']
+            if generation is None or generation != cache['generation']:
+                _logger.debug('Training data on USB has changed')
+                return None
+            cache['stamp'] = stamp
+        return cache['data']
+
+    def _set_cached_data(self, usb_data_path, sugar_data_path, data,
+                         generation):
+        if usb_data_path is None:
+            stamp = None
         else:
-            usb_data_path = os.path.join(
-                self.activity.volume_data[0]['usb_path'],
-                self.activity.volume_data[0]['uid'])
-            sugar_data_path = os.path.join(
-                self.activity.volume_data[0]['sugar_path'],
-                self.activity.volume_data[0]['uid'])
-
-        if usb_data_path is not None and os.path.exists(usb_data_path):
-            if self._resync_required:
-                # Last time, we couldn't read, so let's make sure the data
-                # sets are in sync.
-                _logger.error('Resyncing data sets')
-                status = self.activity.sync_data_from_USB(usb_data_path)
-                if not status:
-                    _logger.error('RESYNC FAILED')
-                self._resync_required = not status
-            try:
-                fd = open(usb_data_path, 'r')
-                json_data = fd.read()
-                fd.close()
-            except Exception, e:
-                # Maybe USB key has been pulled?
-                _logger.error('Could not read from %s: %s' %
-                              (usb_data_path, e))
-                json_data = ''
-                usb_read_failed = True
-            try:
-                if len(json_data) > 0:
-                    data = json.loads(json_data)
-            except ValueError, e:
-                _logger.error('Cannot read training data: %s' % e)
-                usb_read_failed = True
+            stamp = utils.get_file_stamp(usb_data_path)
+        self._last_data = data
+        self._data_cache = {'usb_path': usb_data_path,
+                            'sugar_path': sugar_data_path,
+                            'data': data,
+                            'generation': generation,
+                            'stamp': stamp}
+
+    def _load_data(self, usb_data_path, sugar_data_path, sugar_primary):
+        ''' Return the training data, its generation and whether reading
+            from the USB key or from Sugar failed. The data is served from
+            memory, then from the shadow copy in Sugar, and only read from
+            the USB key when it has changed. '''
+        data = self._get_cached_data(usb_data_path, sugar_data_path,
+                                     sugar_primary)
+        if data is not None:
+            return data, self._data_cache['generation'], False, False
+
+        result = None
+        usb_read_failed = usb_data_path is None
+        sugar_read_failed = False
+        if not usb_read_failed and not sugar_primary and \
+           os.path.exists(usb_data_path):
+            if self._is_shadow_copy_current(usb_data_path, sugar_data_path):
+                result = self._read_training_data(sugar_data_path)
+            if result is None:
+                result = self._read_training_data(usb_data_path)
+                usb_read_failed = result is None
 
         # If for some reason USB read fails, try reading from Sugar
-        if usb_read_failed and sugar_data_path is not None:
-            _logger.error('read_task_data: Resync required')
-            self._resync_required = True
-
+        if (usb_read_failed or sugar_primary) and sugar_data_path is not None:
             if os.path.exists(sugar_data_path):
-                try:
-                    fd = open(sugar_data_path, 'r')
-                    json_data = fd.read()
-                    fd.close()
-                except Exception, e:
-                    json_data = ''
-                    _logger.error('Could not read from %s: %s' %
-                                  (sugar_data_path, e))
-                if len(json_data) > 0:
-                    try:
-                        data = json.loads(json_data)
-                    except ValueError, e:
-                        _logger.error('Cannot load training data: %s' % e)
+                result = self._read_training_data(sugar_data_path)
+                sugar_read_failed = result is None
+
+        if sugar_primary and sugar_read_failed:
+            # The Sugar copy was the only up-to-date copy, but we cannot
+            # read it: go back to reading and writing the USB key directly
+            # rather than carry on with no data.
+            self.activity.sugar_primary = False
+            self._usb_dirty = False
+            self._require_resync('_load_data')
+            if usb_data_path is not None and os.path.exists(usb_data_path):
+                result = self._read_training_data(usb_data_path)
+                usb_read_failed = result is None
+
+        if result is None:
+            result = ({}, None)
+        data, generation = result
+        self._last_data = data
+        if not usb_read_failed and not sugar_read_failed:
+            self._set_cached_data(usb_data_path, sugar_data_path, data,
+                                  generation)
+        return data, generation, usb_read_failed, sugar_read_failed
+
+    def read_task_data(self, uid=None):
+        if self._is_resync_running() and self._last_data is not None:
+            # Don't touch the files while they are being resynced (see
+            # queue_resync): carry on with the data in memory.
+            data = self._last_data
+        else:
+            data = self._read_task_data()
 
+        # The data may be held in memory, so return a copy.
         if uid is None:
-            return data
+            return copy.deepcopy(data)
         elif uid in data:
-            uid_data = data[uid]
+            return copy.deepcopy(data[uid])
+        return None
+
+    def _read_task_data(self):
+        usb_data_path, sugar_data_path = self._get_data_paths()
+        if usb_data_path is None:
+            _logger.error('No USB device found... trying to read from Sugar.')
+
+        self._flush_if_usb_primary()
+        sugar_primary = self._is_sugar_primary(sugar_data_path)
 
-        return uid_data
+        data, generation, usb_read_failed, sugar_read_failed = \
+            self._load_data(usb_data_path, sugar_data_path, sugar_primary)
+
+        if usb_read_failed and sugar_data_path is not None:
+            self._require_resync('read_task_data')
+        return data
 
     def write_task_data(self, uid, uid_data):
-        usb_data_path = None
-        sugar_data_path = self._sugar_data_path
-        usb_read_failed = False
-        sugar_read_failed = False
-        data = {}
+        if self._is_resync_running() and self._last_data is not None:
+            # Write once the resync is done (see __resync_done_cb), but
+            # let the tasks read their data back in the meantime.
+            self._pending_writes.append((uid, copy.deepcopy(uid_data)))
+            self._last_data[uid] = copy.deepcopy(uid_data)
+            return
+        self._write_task_data(uid, uid_data)
 
-        if len(self.activity.volume_data) == 0:
+    def _write_task_data(self, uid, uid_data):
+        usb_data_path, sugar_data_path = self._get_data_paths()
+        if usb_data_path is None:
             _logger.error('No USB device found... cannot save results.')
-            usb_read_failed = True
-        else:
-            sugar_data_path = os.path.join(
-                self.activity.volume_data[0]['sugar_path'],
-                self.activity.volume_data[0]['uid'])
-            usb_data_path = os.path.join(
-                self.activity.volume_data[0]['usb_path'],
-                self.activity.volume_data[0]['uid'])
+
+        self._flush_if_usb_primary()
+        sugar_primary = self._is_sugar_primary(sugar_data_path)
 
         # Read before write
-        if not usb_read_failed and os.path.exists(usb_data_path):
-            try:
-                fd = open(usb_data_path, 'r')
-                json_data = fd.read()
-                fd.close()
-            except Exception, e:
-                # Maybe USB key has been pulled?
-                _logger.error('Could not read from %s: %s' %
-                              (usb_data_path, e))
-                json_data = ''
-                usb_read_failed = True
-            if len(json_data) > 0:
-                try:
-                    data = json.loads(json_data)
-                except ValueError, e:
-                    _logger.error('Cannot load training data: %s' % e)
-                    usb_read_failed = True
+        data, generation, usb_read_failed, sugar_read_failed = \
+            self._load_data(usb_data_path, sugar_data_path, sugar_primary)
+        # We may have fallen back to the USB key (see _load_data)
+        sugar_primary = self._is_sugar_primary(sugar_data_path)
 
-        # If for some reason USB read fails, try reading from Sugar
-        if usb_read_failed and sugar_data_path is not None:
-            if os.path.exists(sugar_data_path):
-                try:
-                    fd = open(sugar_data_path, 'r')
-                    json_data = fd.read()
-                    fd.close()
-                except Exception, e:
-                    _logger.error('Could not read from %s: %s' %
-                                  (sugar_data_path, e))
-                    json_data = ''
-                    sugar_read_failed = True
-                if len(json_data) > 0:
-                    try:
-                        data = json.loads(json_data)
-                    except ValueError, e:
-                        _logger.error('Cannot load training data: %s' % e)
-                        sugar_read_failed = True
-
-        if usb_read_failed and sugar_read_failed:
+        if (usb_read_failed or sugar_primary) and sugar_read_failed:
             _logger.error('Cannot read training data in read before write')
             return
 
-        data[uid] = uid_data
+        data[uid] = copy.deepcopy(uid_data)
+        if isinstance(uid_data, dict):
+            # Used to choose the newest copy of the record when merging
+            # the USB and Sugar copies (see utils.merge_training_data)
+            data[uid]['modified'] = int(time.time() + 0.5)
 
         # Make sure the volume UID and version number are present
         data[TRAINING_DATA_UID] = self.activity.get_uid()
         data[VERSION_NUMBER] = self.activity.get_activity_version()
 
-        json_data = json.dumps(data)
-
-        # Write to the USB and ...
-        if not usb_read_failed:
-            try:
-                fd = open(usb_data_path, 'w')
-                fd.write(json_data)
-                fd.close()
-            except Exception, e:
-                _logger.error('Could not write to USB %s: %s' %
-                              (usb_data_path, e))
-                _logger.error('write_task_data: Resync required')
-                self._resync_required = True
-
-        # ... save shadow copy in Sugar
+        # The generation lets us check cheaply that the data has not been
+        # changed by someone else (see _get_cached_data).
+        if generation is None:
+            generation = 0
+        generation += 1
+        json_data = utils.dump_training_data(data, generation)
+
+        # Write to the USB and save shadow copy in Sugar at the same
+        # time, so a write takes as long as the slower of the two.
+        pool = utils.get_thread_pool()
+        write_usb = not usb_read_failed and not sugar_primary
+        if write_usb:
+            usb_result = pool.apply_async(self._write_training_data,
+                                          (usb_data_path, json_data))
+        sugar_result = pool.apply_async(self._write_training_data,
+                                        (sugar_data_path, json_data))
+
+        if write_usb and not usb_result.get():
+            self._require_resync('write_task_data')
+
+        if sugar_result.get():
+            if usb_read_failed:
+                self._require_resync('write_task_data')
+            elif sugar_primary:
+                # The USB key is written at badges and on close.
+                self._usb_dirty = True
+        elif sugar_primary and not usb_read_failed:
+            # Don't leave the data only in memory
+            if not self._write_training_data(usb_data_path, json_data):
+                self._require_resync('write_task_data')
+
+        self._set_cached_data(usb_data_path, sugar_data_path, data, generation)
+
+    def _write_training_data(self, path, json_data):
         try:
-            fd = open(sugar_data_path, 'w')
+            fd = open(path, 'w')
             fd.write(json_data)
             fd.close()
+        except Exception, e:
+            _logger.error('Could not write to %s: %s' % (path, e))
+            return False
+        return True
 
-            if usb_read_failed:
-                _logger.error('write_task_data: Resync required')
-                self._resync_required = True
+    def _is_sugar_primary(self, sugar_data_path):
+        ''' Is the Sugar copy of the training data more recent than the
+            copy on a slow USB key? '''
+        return self.activity.sugar_primary and \
+            sugar_data_path is not None and os.path.exists(sugar_data_path)
+
+    def _flush_if_usb_primary(self):
+        # e.g., a faster USB key was inserted
+        if self._usb_dirty and not self.activity.sugar_primary:
+            self.flush_to_usb()
+
+    def flush_to_usb(self):
+        ''' Copy the Sugar copy of the training data to a slow USB key,
+            whose writes are deferred (see write_task_data) '''
+        # Called at badges and on close, so wait for any resync and the
+        # writes queued behind it.
+        self._finish_resync()
+        if not self._usb_dirty:
+            return True
+        if len(self.activity.volume_data) == 0:
+            _logger.error('No USB device found... cannot flush results.')
+            return False
+
+        usb_data_path = os.path.join(self.activity.volume_data[0]['usb_path'],
+                                     self.activity.volume_data[0]['uid'])
+        sugar_data_path = os.path.join(
+            self.activity.volume_data[0]['sugar_path'],
+            self.activity.volume_data[0]['uid'])
+        try:
+            fd = open(sugar_data_path, 'r')
+            json_data = fd.read()
+            fd.close()
         except Exception, e:
-            _logger.error('Could not write to Sugar %s: %s' %
-                          (sugar_data_path, e))
+            _logger.error('Could not read from %s: %s' % (sugar_data_path, e))
+            return False
+
+        start_time = time.time()
+        if not self._write_training_data(usb_data_path, json_data):
+            self._require_resync('flush_to_usb')
+            return False
+        self._usb_dirty = False
+        _logger.debug('Flushed training data to USB in %.3fs' %
+                      (time.time() - start_time))
+        return True
+
+    def _require_resync(self, caller):
+        _logger.error('%s: Resync required' % caller)
+        self._resync_required = True
+        self.queue_resync()
+
+    def queue_resync(self, delay=_RESYNC_DELAY):
+        ''' Resync the USB and Sugar copies of the training data in the
+            background, if required, once things have settled down. Called
+            after a failure and when the mounted volumes change. '''
+        # A resync that is already queued or running is not put off
+        # again, so repeated failures cannot starve it.
+        if not self._resync_required or \
+           self._resync_timeout_id is not None or self._is_resync_running():
+            return
+        self._resync_timeout_id = GObject.timeout_add(
+            delay, self.__resync_timeout_cb)
+
+    def _is_resync_running(self):
+        return self._resync_result is not None
+
+    def __resync_timeout_cb(self):
+        self._resync_timeout_id = None
+        if not self._resync_required or self._is_resync_running():
+            return False
+        usb_data_path, sugar_data_path = self._get_data_paths()
+        if usb_data_path is None or not os.path.exists(usb_data_path) or \
+           self._is_sugar_primary(sugar_data_path):
+            # Wait for the USB key to come back (or to be flushed).
+            return False
+
+        _logger.error('Resyncing data sets')
+        # The files are left to the worker until it is done: reads and
+        # writes are served from memory meanwhile.
+        self._resync_result = utils.get_thread_pool().apply_async(
+            self._resync, (usb_data_path, sugar_data_path),
+            callback=lambda result: GObject.idle_add(
+                self.__resync_done_cb, usb_data_path))
+        return False
+
+    def _resync(self, usb_data_path, sugar_data_path):
+        # Run in a worker thread: no UI and no TaskMaster state here.
+        try:
+            return utils.sync_training_data(usb_data_path, sugar_data_path)
+        except Exception, e:
+            return utils.SYNC_READ_FAILED, str(e)
+
+    def _finish_resync(self):
+        ''' Wait for a running resync to finish '''
+        if self._is_resync_running():
+            self._resync_result.wait()
+            usb_data_path, sugar_data_path = self._get_data_paths()
+            self.__resync_done_cb(usb_data_path)
+
+    def __resync_done_cb(self, usb_data_path):
+        if self._resync_result is None or not self._resync_result.ready():
+            # Already handled (see _finish_resync)
+            return False
+        result = self._resync_result.get()
+        self._resync_result = None
+        # The merged data may be different from the data in memory.
+        self._data_cache = None
+
+        if self.activity.sync_data_done(result, usb_data_path):
+            self._resync_required = False
+            self._resync_failures = 0
+        else:
+            _logger.error('RESYNC FAILED')
+
+        pending_writes, self._pending_writes = self._pending_writes, []
+        for uid, uid_data in pending_writes:
+            self._write_task_data(uid, uid_data)
+
+        if self._resync_required and result[0] == utils.SYNC_READ_FAILED:
+            # Try again, less and less often
+            self._resync_failures += 1
+            self.queue_resync(min(_RESYNC_DELAY << self._resync_failures,
+                                  _MAX_RESYNC_DELAY))
+        return False
 
     def _prev_task_button_cb(self, button):
         section_index, task_index = self.get_section_and_task_index()
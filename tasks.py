@@ -15,7 +15,6 @@ from gettext import gettext as _
 
 from gi.repository import GObject
 from gi.repository import Gtk
-from gi.repository import Gdk
 
 from sugar3.datastore import datastore
 from sugar3.graphics.alert import NotifyAlert
@@ -27,6 +26,7 @@ from activity import (NAME_UID, EMAIL_UID, SCHOOL_UID, ROLE_UID, SCHOOL_NAME,
                       POST_CODE)
 from graphics import Graphics, FONT_SIZES
 import utils
+import schools
 from reporter import Reporter
 
 # These tasks are requirements for other tasks
@@ -64,6 +64,9 @@ GET_CONNECTED_TASK = 'get-connected-task'
 _ASSESSMENT_MIME_TYPE = 'application/vnd.ms-excel'
 _ASSESSMENT_SUFFIX = '.xls'
 
+# The most schools suggested as the school name is typed
+_MAX_SCHOOL_SUGGESTIONS = 10
+
 _ROLES = {
     'Teacher': [_('Teacher'), True],
     'Principal': [_('Principal'), True],
@@ -392,6 +395,7 @@ class BadgeTask(HTMLTask):
                 self._name,
                 icon=self._task_master.get_section_icon(self._section_index))
             self._task_master.write_task_data(self.uid, task_data)
+        self._task_master.flush_to_usb()
 
         GObject.idle_add(self._report_progress)
         return True
@@ -952,13 +956,13 @@ class Connected6Task(HTMLTask):
         self._height = 60
         self._graphics = None
         self._school_entry = None
+        self._school_entry_changed_id = None
         self._postal_code_entry = None
         self._postal_code_changed = True
         self._postal_code = -1
-        self._buttons = []
         self._schools = []
         self._sf_ids = []
-        self._results = []
+        self._suggestions = None
         self._default_sf_id = '0019000000pETbT'
         self._completer = None
         self._task_data = None
@@ -987,12 +991,11 @@ class Connected6Task(HTMLTask):
         except:
             return False
         if i >= 0 and i < 9999:
-            # if self._postal_code != i or self._postal_code_changed:
-            self._postal_code_changed = True
-            self._postal_code = i
-            self._task_master.write_task_data(POST_CODE, target)
-            # else:
-            #     self._postal_code_changed = False
+            # Only rebuild the list of schools if the postal code changed
+            if self._postal_code != i:
+                self._postal_code_changed = True
+                self._postal_code = i
+                self._task_master.write_task_data(POST_CODE, target)
             return True
         else:
             return False
@@ -1012,44 +1015,20 @@ class Connected6Task(HTMLTask):
             return False
 
         if self._postal_code_changed:
-            # get rid of any old buttons
-            for button in self._buttons:
-                button.destroy()
-
-            f = open(os.path.join(self._task_master.activity.bundle_path,
-                                  'schools.txt'), 'r')
-            schools = f.read().split('\n')
-            f.close()
+            schools_index = self._get_schools_index()
+            self._default_sf_id = schools_index.default_sf_id
             self._schools = []
             self._sf_ids = []
-            for school in schools:
-                if len(school) == 0:
-                    continue
-                try:
-                    sf_id, name, campus, address, city, state, postal_code = \
-                        school.split(',')
-                except:
-                    _logger.debug('bad school data? (%s)' % school)
-                # save the SF_ID from One Education in case we need it
-                if name == 'One Education School':
-                    self._default_sf_id = sf_id
-                try:
-                    if int(postal_code) != self._postal_code:
-                        continue
-                except:
-                    _logger.error('bad postal code? (%s: %s)' %
-                                  (name, postal_code))
-                    continue
-                if len(campus) > 0:
-                    self._schools.append('%s %s, %s, %s' %
-                                         (name, campus, city, state))
-                else:
-                    self._schools.append('%s, %s, %s' % (name, city, state))
+            schools_list = schools_index.lookup(self._postal_code)
+            if len(schools_list) == 0:
+                # Maybe the school is registered under a neighbouring
+                # postal code
+                schools_list = schools_index.lookup_nearby(self._postal_code)
+            for school, sf_id in schools_list:
+                self._schools.append(school)
                 self._sf_ids.append(sf_id)
             # _logger.debug('%d schools in the list' %  (len(self._schools)))
             self._completer = utils.Completer(self._schools)
-            if len(self._schools) < 10:
-                self._make_buttons(self._schools)
 
         self._postal_code_changed = False
         if len(self._school_entry.get_text()) == 0:
@@ -1057,41 +1036,76 @@ class Connected6Task(HTMLTask):
         else:
             return True
 
-    def _make_buttons(self, school_list):
-        for button in self._buttons:
-            button.destroy()
-        self._buttons = []
-        for i, school in enumerate(school_list):
-            self._buttons.append(
-                self._graphics.add_button(school, self._button_cb, arg=school))
-            self._buttons[-1].show()
-
-    def _button_cb(self, widget, text):
-        self._school_entry.set_text(text)
-        for button in self._buttons:
-            button.destroy()
+    def _get_schools_index(self):
+        activity = self._task_master.activity
+        return schools.get_schools_index(
+            os.path.join(activity.bundle_path, 'schools.txt'),
+            os.path.join(activity.get_activity_root(), 'data',
+                         'schools.bin'),
+            prebuilt_path=os.path.join(activity.bundle_path, 'schools.bin'))
+
+    def _prepare_school_search(self):
+        utils.get_thread_pool().apply_async(
+            self._get_schools_index().build_search_index)
+        return False
+
+    def _get_suggestions(self, text):
+        if len(text) == 0:
+            return self._schools[:_MAX_SCHOOL_SUGGESTIONS]
+        if self._is_valid_postal_code_entry() and self._completer is not None:
+            results = self._completer.complete(
+                text, 0, limit=_MAX_SCHOOL_SUGGESTIONS)
+        else:
+            # No postal code yet, so complete from all of the schools in
+            # the index
+            results = self._get_schools_index().complete(
+                text, limit=_MAX_SCHOOL_SUGGESTIONS)
+        if len(results) == 0:
+            # Nothing starts with the text, so allow for typos, missing
+            # apostrophes, words out of order, etc.
+            results = self._get_schools_index().search(
+                text, limit=_MAX_SCHOOL_SUGGESTIONS)
+        return results
+
+    def _update_suggestions(self, text):
+        ''' Update the rows of the completion model in place '''
+        results = self._get_suggestions(text)
+        model = self._suggestions
+        row = model.get_iter_first()
+        for school in results:
+            if row is None:
+                model.append([school])
+            else:
+                if model.get_value(row, 0) != school:
+                    model.set_value(row, 0, school)
+                row = model.iter_next(row)
+        # remove moves the row on to the next one
+        while row is not None:
+            if not model.remove(row):
+                break
+        self._school_entry.get_completion().complete()
+
+    def _school_match_cb(self, completion, key, row, data):
+        # The model only holds the suggestions for the text entered.
+        return True
+
+    def _school_match_selected_cb(self, completion, model, row):
+        # Don't filter the suggestions again (and pop them back up).
+        self._school_entry.handler_block(self._school_entry_changed_id)
+        self._school_entry.set_text(model.get_value(row, 0))
+        self._school_entry.handler_unblock(self._school_entry_changed_id)
+        self._school_entry.set_position(-1)
+        return True
+
+    def _school_entry_changed_cb(self, widget):
+        self._update_suggestions(widget.get_text())
 
     def _school_entry_focus_cb(self, widget, event):
         if not self._is_valid_postal_code_entry():
             return
         elif len(widget.get_text()) == 0 and len(self._schools) > 0:
-            self._make_buttons(self._schools)
-
-    def _school_entry_release_cb(self, widget, event):
-        if len(self._results) == 1:
-            widget.set_text(self._results[0])
-            for button in self._buttons:
-                button.destroy()
-        elif len(self._results) < 10:
-            for button in self._buttons:
-                button.destroy()
-            self._make_buttons(self._results)
-
-    def _school_entry_press_cb(self, widget, event):
-        if not self._is_valid_postal_code_entry():
-            return
-        self._results = self._completer.complete(
-            widget.get_text() + Gdk.keyval_name(event.keyval), 0)
+            # Pop up the schools for the postal code.
+            widget.emit('changed')
 
     def _yes_no_cb(self, widget, arg):
         if arg == 'yes':
@@ -1113,8 +1127,12 @@ class Connected6Task(HTMLTask):
     def after_button_press(self):
         school = self._school_entry.get_text()
         if school in self._schools:
-            i = self._schools.index(school)
-            self._task_master.write_task_data(SCHOOL_UID, self._sf_ids[i])
+            sf_id = self._sf_ids[self._schools.index(school)]
+        else:
+            # Maybe the school was found without the postal code
+            sf_id = self._get_schools_index().get_sf_id(school)
+        if sf_id is not None:
+            self._task_master.write_task_data(SCHOOL_UID, sf_id)
             self._task_master.write_task_data(SCHOOL_NAME, school)
             _logger.debug('Wrote SCHOOL_UID AND SCHOOL_NAME to task_data file')
             return True
@@ -1160,14 +1178,25 @@ class Connected6Task(HTMLTask):
         else:
             self._school_entry = self._graphics.add_entry()
 
-        self._school_entry.connect('key-release-event',
-                                   self._school_entry_release_cb)
-        self._school_entry.connect('key-press-event',
-                                   self._school_entry_press_cb)
+        self._suggestions = Gtk.ListStore(str)
+        completion = Gtk.EntryCompletion()
+        completion.set_model(self._suggestions)
+        completion.set_text_column(0)
+        completion.set_match_func(self._school_match_cb, None)
+        completion.set_minimum_key_length(0)
+        completion.connect('match-selected', self._school_match_selected_cb)
+        self._school_entry.set_completion(completion)
+
+        self._school_entry_changed_id = self._school_entry.connect(
+            'changed', self._school_entry_changed_cb)
         self._school_entry.connect('focus-in-event',
                                    self._school_entry_focus_cb)
         self._school_entry.connect('activate', self._school_enter_entered)
 
+        # Build the typo-tolerant search off the main loop, while the
+        # postal code is being entered.
+        GObject.idle_add(self._prepare_school_search)
+
         self._postal_code_entry.grab_focus()
 
         return self._graphics, self._prompt
@@ -1355,9 +1384,10 @@ class Activities3Task(HTMLTask):
         if not utils.saw_new_launch('org.laptop.RecordActivity',
                                     utils.recently(task_data['start_time'])):
             return False
-        paths = utils.get_jpg()
-        return len(paths) > 0 and (utils.get_modified_time(paths[0]) >
-                                   utils.recently(task_data['start_time']))
+        for entry in utils.find_by_mime(
+                ['image/jpeg'], since=utils.recently(task_data['start_time'])):
+            return True
+        return False
 
 
 class Activities4Task(HTMLTask):
@@ -1396,11 +1426,11 @@ class Activities5Task(HTMLTask):
         # We need the clipboard text for the Speak task
         # if not utils.is_clipboard_text_available():
         #     return False
-        paths = utils.get_odt()
-        for path in paths:
+        for entry in utils.find_by_mime(
+                ['application/vnd.oasis.opendocument.text']):
             # Check to see if there is a picture in the file:
             # look for '\\pict' in RTF, 'Pictures' in ODT
-            if utils.find_string(path, 'Pictures'):
+            if utils.find_string(entry.file_path, 'Pictures'):
                 return True
         return False
 
@@ -1572,13 +1602,12 @@ class Journal5Task(HTMLTask):
         if not utils.saw_new_launch('org.sugarlabs.PortfolioActivity',
                                     utils.recently(task_data['start_time'])):
             return False
-        paths = utils.get_pdf()
-        if len(paths) == 0:
-            return False
-        for path in paths:
-            if utils.get_modified_time(path) > \
-               utils.recently(task_data['start_time']):
-                return True
+        # We only need the metadata of PDFs saved since the task started,
+        # not the files themselves.
+        for entry in utils.find_by_mime(
+                ['application/pdf'],
+                since=utils.recently(task_data['start_time'])):
+            return True
         return False
 
 
@@ -2080,11 +2109,10 @@ class Turtle3Task(HTMLTask):
         if activity is not None:
             path = activity.file_path
             if os.path.exists(path):
-                if not utils.find_string(path, 'left') and \
-                   not utils.find_string(path, 'right'):
+                blocks = utils.get_turtle_blocks(path)
+                if not 'left' in blocks and not 'right' in blocks:
                     return False
-                if not utils.find_string(path, 'forward') and \
-                   not utils.find_string(path, 'back'):
+                if not 'forward' in blocks and not 'back' in blocks:
                     return False
                 return True
         return False
@@ -2124,7 +2152,7 @@ class Turtle5Task(HTMLTask):
             'org.laptop.TurtleArtActivity')
         if activity is not None:
             path = activity.file_path
-            return utils.find_string(path, 'repeat')
+            return 'repeat' in utils.get_turtle_blocks(path)
         return False
 
     def get_my_turn(self):
@@ -2162,8 +2190,8 @@ class Turtle7Task(HTMLTask):
             'org.laptop.TurtleArtActivity')
         if activity is not None:
             path = activity.file_path
-            if not utils.find_string(path, 'setpensize') and \
-               not utils.find_string(path, 'setcolor'):
+            blocks = utils.get_turtle_blocks(path)
+            if not 'setpensize' in blocks and not 'setcolor' in blocks:
                 return False
             return True
         return False
@@ -2200,7 +2228,7 @@ class Turtle9Task(HTMLTask):
             'org.laptop.TurtleArtActivity')
         if activity is not None:
             path = activity.file_path
-            if not utils.find_string(path, 'show'):
+            if not 'show' in utils.get_turtle_blocks(path):
                 return False
             return True
         return False
@@ -2237,7 +2265,7 @@ class Turtle11Task(HTMLTask):
             'org.laptop.TurtleArtActivity')
         if activity is not None:
             path = activity.file_path
-            if not utils.find_string(path, 'journal'):
+            if not 'journal' in utils.get_turtle_blocks(path):
                 return False
         return True
 
@@ -24,6 +24,11 @@ import cairo
 import email.utils
 import re
 import time
+import mmap
+import bisect
+import hashlib
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from gi.repository import Vte
 from gi.repository import Gio
@@ -78,6 +83,48 @@ proxy = None
 TRAINING_DATA = 'training-data-%s'
 TRAINING_SUFFIX = '.txt'
 
+# Task tests poll the datastore every second, so cache the results of the
+# queries for a few seconds (or until the datastore reports a change).
+_DATASTORE_CACHE_TTL = 5  # seconds
+
+# The only metadata the task tests look at: requesting just these (and only
+# the most recent few objects) bounds the size of each query.
+_INSTANCE_PROPERTIES = ['uid', 'activity', 'mime_type', 'keep', 'launch-times',
+                        'creation_time', 'timestamp', 'description',
+                        'share-scope', 'title']
+_RECENT_INSTANCE_LIMIT = 10
+
+# Files larger than this are scanned through mmap
+_MMAP_THRESHOLD = 1024 * 1024
+_SCAN_CHUNK_SIZE = 64 * 1024
+
+# Parsed Turtle Art projects to keep
+_TURTLE_CACHE_SIZE = 8
+
+# The fields used to choose between training-data files, and the
+# generation: a count of the writes, used to check that a file has not
+# been changed since it was last read
+_TRAINING_SUMMARY_FIELDS = ['email_address', 'name', 'completion_percentage',
+                            'training_data_uid', 'generation']
+# Written (and removed) to measure the latency of a USB key
+_LATENCY_PROBE = '.training-latency-probe'
+_LATENCY_PROBE_SIZE = 4096
+
+_MOUNTINFO_PATH = '/proc/self/mountinfo'
+
+# The summary is written first, so it can be read without parsing the
+# task records.
+_TRAINING_SUMMARY = 'training_data_summary'
+_TRAINING_SUMMARY_HEADER = '{"%s": ' % _TRAINING_SUMMARY
+_TRAINING_SUMMARY_READ_SIZE = 512
+# Results of sync_training_data
+SYNC_OK = 'ok'
+SYNC_EMAIL_MISMATCH = 'email-mismatch'
+SYNC_USB_WRITE_FAILED = 'usb-write-failed'
+SYNC_READ_FAILED = 'read-failed'
+# Threads used for reading from (slow) USB keys
+_THREAD_POOL_SIZE = 4
+
 
 def is_valid_email_entry(entry):
     if len(entry) == 0:
@@ -177,103 +224,345 @@ def check_volume_suffix(volume_file):
         return TRAINING_DATA % new_volume_file[-13:]
 
 
-def look_for_training_data(path):
-    ''' look for .txt suffix, .bin suffix, and finally, no suffix '''
+_TRAINING_DATA_PREFIX = TRAINING_DATA % ''
+# Files are listed by suffix: .txt, then .bin (see SEP-33), then the rest
+_TRAINING_DATA_SUFFIX_ORDER = {TRAINING_SUFFIX: 0, '.bin': 1}
+
+
+def scan_training_data(path):
+    ''' Find the training-data files in path with a single directory
+        listing. Returns a list of entries with the name, suffix, size and
+        mtime of each file. '''
+    try:
+        names = os.listdir(path)
+    except OSError as e:
+        _logger.error('Could not list %s: %s' % (path, e))
+        return []
+
     training_data = []
-    glob_data = glob.glob(os.path.join(path, 'training-data-*.txt'))
-    for path in glob_data:
-        # Ignore files starting with # or ending with ~
-        if path[0] == '#':
-            continue
-        if path[-1] == '~':
+    for name in names:
+        if not name.startswith(_TRAINING_DATA_PREFIX):
             continue
-        training_data.append(path)
-    glob_data = glob.glob(os.path.join(path, 'training-data-*.bin'))
-    for path in glob_data:
-        # Ignore files starting with # or ending with ~
-        if path[0] == '#':
+        # Ignore backup files (emacs lock and autosave files, .#... and
+        # #...#, never start with the prefix)
+        if name[-1] == '~':
             continue
-        if path[-1] == '~':
-            continue
-        training_data.append(path)
-    glob_data = glob.glob(os.path.join(path, 'training-data-*'))
-    for path in glob_data:
-        # Ignore files starting with # or ending with ~
-        if path[0] == '#':
-            continue
-        if path[-1] == '~':
+        file_path = os.path.join(path, name)
+        try:
+            stats = os.stat(file_path)
+        except OSError as e:
+            _logger.error('Could not stat %s: %s' % (file_path, e))
             continue
-        # Make sure we are not adding the same file twice
-        if path in training_data:
+        if not stat.S_ISREG(stats.st_mode):
             continue
-        training_data.append(path)
+        training_data.append({'path': file_path,
+                              'name': name,
+                              'suffix': os.path.splitext(name)[1],
+                              'size': stats.st_size,
+                              'mtime': stats.st_mtime})
+
+    training_data.sort(key=lambda entry: (
+        _TRAINING_DATA_SUFFIX_ORDER.get(entry['suffix'], 2), entry['name']))
     return training_data
 
 
-def get_email_from_training_data(path):
+def look_for_training_data(path):
+    ''' look for .txt suffix, .bin suffix, and finally, no suffix '''
+    return [entry['path'] for entry in scan_training_data(path)]
+
+
+_training_summaries = {}
+_thread_pool = None
+
+
+def get_thread_pool():
+    ''' A pool of threads shared by the activity for file I/O '''
+    global _thread_pool
+    if _thread_pool is None:
+        # Let the threads run while the main loop is waiting.
+        GObject.threads_init()
+        _thread_pool = ThreadPool(_THREAD_POOL_SIZE)
+    return _thread_pool
+
+
+def _get_training_summary(data):
+    summary = {}
+    for field in _TRAINING_SUMMARY_FIELDS:
+        summary[field] = data.get(field)
+    return summary
+
+
+def dump_training_data(data, generation=None):
+    ''' Serialize training data with a summary (see load_training_summary)
+        as its first member '''
+    data = dict(data)
+    data.pop(_TRAINING_SUMMARY, None)
+    # Sorted, so the same data is always written the same way
+    json_data = json.dumps(data, sort_keys=True)
+    summary = _get_training_summary(data)
+    summary['generation'] = generation
+    header = _TRAINING_SUMMARY_HEADER + json.dumps(summary, sort_keys=True)
+    if len(data) == 0:
+        return header + '}'
+    return header + ', ' + json_data[1:]
+
+
+def load_training_data(json_data):
+    ''' Parse training data (with or without a summary); the summary is
+        not returned as it is rewritten by dump_training_data '''
+    data = json.loads(json_data)
+    if isinstance(data, dict):
+        data.pop(_TRAINING_SUMMARY, None)
+    return data
+
+
+def hash_training_data(data):
+    ''' A hash of the training data, to tell if two copies are the same '''
+    return hashlib.sha1(json.dumps(data, sort_keys=True)).hexdigest()
+
+
+# Records written before they were stamped with 'modified' only carry the
+# times of the task, so fall back to those, in this order.
+_RECORD_TIMES = ['modified', 'end_time', 'start_time', 'accumulated_time']
+
+
+def _get_record_times(record):
+    return tuple([record.get(key) or 0 for key in _RECORD_TIMES])
+
+
+def _get_modified(record):
+    ''' When was a task record last changed (as far as we can tell)? '''
+    for key in _RECORD_TIMES[:-1]:
+        if record.get(key):
+            return record[key]
+    return 0
+
+
+def _merge_task_records(record_one, record_two):
+    ''' Choose between two copies of a task record: a completed task
+        stays completed, otherwise the most recently modified copy wins
+        (see _RECORD_TIMES). Ties are broken on the content of the
+        records, so the result does not depend on the order of the
+        arguments. '''
+    completed_one = bool(record_one.get('completed'))
+    completed_two = bool(record_two.get('completed'))
+    if completed_one != completed_two:
+        return record_one if completed_one else record_two
+    if _get_record_times(record_one) != _get_record_times(record_two):
+        return max(record_one, record_two, key=_get_record_times)
+    return max(record_one, record_two,
+               key=lambda record: json.dumps(record, sort_keys=True))
+
+
+def merge_training_data(usb_data, sugar_data):
+    ''' Merge two copies of the training data in one pass over the keys.
+        Task records (dictionaries) are merged by _merge_task_records;
+        other values (name, email_address, current_task...) are taken from
+        the copy with the most recently modified task record (the USB copy
+        if they are the same). '''
+    usb_modified = max([_get_modified(value) for value in usb_data.values()
+                        if isinstance(value, dict)] + [0])
+    sugar_modified = max([_get_modified(value)
+                          for value in sugar_data.values()
+                          if isinstance(value, dict)] + [0])
+    usb_first = usb_modified >= sugar_modified
+
+    data = {}
+    for key in set(usb_data.keys()) | set(sugar_data.keys()):
+        if not key in sugar_data:
+            data[key] = usb_data[key]
+        elif not key in usb_data:
+            data[key] = sugar_data[key]
+        elif isinstance(usb_data[key], dict) and \
+                isinstance(sugar_data[key], dict):
+            data[key] = _merge_task_records(usb_data[key], sugar_data[key])
+        elif usb_first:
+            data[key] = usb_data[key]
+        else:
+            data[key] = sugar_data[key]
+    return data
+
+
+def _read_training_data_file(path):
+    ''' Returns the training data in a file and its generation; a missing
+        file or bad data is treated as empty '''
+    if not os.path.exists(path):
+        _logger.error('Cannot find training data: %s' % path)
+        return {}, None
+    fd = open(path, 'r')
+    json_data = fd.read()
+    fd.close()
+    if len(json_data) == 0:
+        return {}, None
     try:
-        fd = open(path, 'r')
-        json_data = fd.read()
-        fd.close()
-    except Exception, e:
-        _logger.error('Could not read from %s: %s' % (path, e))
-        return None
+        return load_training_data(json_data), \
+            get_training_generation(json_data)
+    except ValueError as e:
+        _logger.error('Cannot load training data %s: %s' % (path, e))
+        return {}, None
+
+
+def sync_training_data(usb_data_path, sugar_data_path):
+    ''' Merge the training data on the USB key with the shadow copy in
+        Sugar and write it back to both, but only if the email addresses
+        match. This does no UI, so it can be run in a worker thread.
+        Returns (SYNC_OK, None), (SYNC_EMAIL_MISMATCH, (usb_email,
+        sugar_email)), (SYNC_USB_WRITE_FAILED, error) or
+        (SYNC_READ_FAILED, error). '''
     try:
-        if len(json_data) > 0:
-            data = json.loads(json_data)
+        usb_data, usb_generation = _read_training_data_file(usb_data_path)
+        sugar_data, sugar_generation = \
+            _read_training_data_file(sugar_data_path)
+    except (IOError, OSError) as e:
+        return SYNC_READ_FAILED, str(e)
+
+    # So we only rewrite the copies that change
+    usb_hash = hash_training_data(usb_data)
+    sugar_hash = hash_training_data(sugar_data)
+
+    # First, check to make sure email_address matches
+    usb_email = usb_data.get('email_address')
+    sugar_email = sugar_data.get('email_address')
+    if usb_email != sugar_email:
+        if usb_email is None and sugar_email is not None:
+            _logger.warning('Using email address from Sugar: %s' %
+                            sugar_email)
+            usb_data['email_address'] = sugar_email
+        elif usb_email is not None and sugar_email is None:
+            _logger.warning('Using email address from USB: %s' % usb_email)
+            sugar_data['email_address'] = usb_email
         else:
-            return None
-    except ValueError, e:
-        _logger.error('Cannot read training data: %s' % e)
-        return None
-    if 'email_address' in data:
-        return data['email_address']
+            return SYNC_EMAIL_MISMATCH, (usb_email, sugar_email)
+
+    data = merge_training_data(usb_data, sugar_data)
+    data_hash = hash_training_data(data)
+    # Keep the generation of an unchanged USB copy, so the shadow copy in
+    # Sugar matches it (see TaskMaster._is_shadow_copy_current).
+    if data_hash == usb_hash and usb_generation is not None:
+        generation = usb_generation
     else:
-        return None
+        generation = max(usb_generation, sugar_generation, 0) + 1
+    json_data = dump_training_data(data, generation)
 
+    # Finally, write to the USB and ...
+    if data_hash == usb_hash:
+        _logger.debug('data sync: USB data is up to date')
+    else:
+        try:
+            fd = open(usb_data_path, 'w')
+            fd.write(json_data)
+            fd.close()
+        except Exception, e:
+            return SYNC_USB_WRITE_FAILED, str(e)
 
-def get_name_from_training_data(path):
-    try:
-        fd = open(path, 'r')
-        json_data = fd.read()
-        fd.close()
-    except Exception, e:
-        _logger.error('Could not read from %s: %s' % (path, e))
+    # ...save a shadow copy in Sugar
+    if data_hash != sugar_hash or sugar_generation != generation:
+        try:
+            fd = open(sugar_data_path, 'w')
+            fd.write(json_data)
+            fd.close()
+        except (IOError, OSError) as e:
+            _logger.error('Could not write to %s: %s' % (sugar_data_path, e))
+    return SYNC_OK, None
+
+
+def _parse_training_summary(head):
+    ''' Parse the summary from the start of a training-data file, or
+        return None if there is no (complete) summary '''
+    if not head.startswith(_TRAINING_SUMMARY_HEADER):
         return None
     try:
-        if len(json_data) > 0:
-            data = json.loads(json_data)
-        else:
-            return None
-    except ValueError, e:
-        _logger.error('Cannot read training data: %s' % e)
+        summary, end = json.JSONDecoder().raw_decode(
+            head, len(_TRAINING_SUMMARY_HEADER))
+    except ValueError:
         return None
-    if 'name' in data:
-        return data['name'].replace(',', ' ')
-    else:
+    if not isinstance(summary, dict):
         return None
+    return _get_training_summary(summary)
 
 
-def get_completed_from_training_data(path):
+def get_training_generation(json_data):
+    ''' The generation in the summary of serialized training data '''
+    summary = _parse_training_summary(json_data[:_TRAINING_SUMMARY_READ_SIZE])
+    if summary is None:
+        return None
+    return summary['generation']
+
+
+def get_file_stamp(path):
+    ''' The modification time and size of a file, or None '''
+    try:
+        stats = os.stat(path)
+    except OSError:
+        return None
+    return (stats.st_mtime, stats.st_size)
+
+
+def _read_training_summary(path):
     try:
         fd = open(path, 'r')
-        json_data = fd.read()
+        json_data = fd.read(_TRAINING_SUMMARY_READ_SIZE)
+        summary = _parse_training_summary(json_data)
+        if summary is None:
+            # An older file (or a very long name): read the whole file
+            json_data += fd.read()
         fd.close()
     except Exception, e:
         _logger.error('Could not read from %s: %s' % (path, e))
         return None
+    if summary is not None:
+        return summary
+    data = {}
     try:
         if len(json_data) > 0:
             data = json.loads(json_data)
-        else:
-            return None
     except ValueError, e:
         _logger.error('Cannot read training data: %s' % e)
-        return None
-    if 'completion_percentage' in data:
-        return data['completion_percentage']
-    else:
-        return None
+    if not isinstance(data, dict):
+        data = {}
+    return _get_training_summary(data)
+
+
+def load_training_summary(path):
+    ''' Return the fields used to choose between training-data files
+        (email_address, name, completion_percentage and training_data_uid)
+        reading the file once. Summaries are cached until the file is
+        modified. '''
+    try:
+        stats = os.stat(path)
+    except OSError, e:
+        _logger.error('Could not read from %s: %s' % (path, e))
+        return dict.fromkeys(_TRAINING_SUMMARY_FIELDS)
+    stamp = (stats.st_mtime, stats.st_size)
+    if path in _training_summaries and _training_summaries[path][0] == stamp:
+        return _training_summaries[path][1]
+    summary = _read_training_summary(path)
+    if summary is None:
+        return dict.fromkeys(_TRAINING_SUMMARY_FIELDS)
+    _training_summaries[path] = (stamp, summary)
+    return summary
+
+
+def load_training_summaries(paths):
+    ''' Load the summaries of several training-data files in parallel '''
+    if len(paths) < 2:
+        return [load_training_summary(path) for path in paths]
+    return get_thread_pool().map(load_training_summary, paths)
+
+
+def get_email_from_training_data(path):
+    return load_training_summary(path)['email_address']
+
+
+def get_name_from_training_data(path):
+    name = load_training_summary(path)['name']
+    if name is not None:
+        return name.replace(',', ' ')
+    return None
+
+
+def get_completed_from_training_data(path):
+    return load_training_summary(path)['completion_percentage']
 
 
 def look_for_xlw(path):
@@ -287,7 +576,10 @@ def look_for_xls(path):
 def remove_xlw_suffix(path):
     if os.path.exists(path):
         if path[-4:] == '.xlw':
-            results = subprocess.check_output(['mv', path, path[:-4]])
+            try:
+                os.rename(path, path[:-4])
+            except OSError as e:
+                _logger.error('Could not rename %s: %s' % (path, e))
 
 
 def set_read_write(path):
@@ -333,6 +625,38 @@ def is_writeable(path):
     return False
 
 
+def measure_write_latency(path):
+    ''' Time writing a small file to path and syncing it to the device.
+        Returns (write, fsync) in seconds, or None if the write failed. '''
+    probe_path = os.path.join(path, _LATENCY_PROBE)
+    fd = None
+    try:
+        start_time = time.time()
+        fd = open(probe_path, 'w')
+        fd.write('\0' * _LATENCY_PROBE_SIZE)
+        fd.flush()
+        write_time = time.time()
+        os.fsync(fd.fileno())
+        fsync_time = time.time()
+    except (IOError, OSError) as e:
+        _logger.error('Could not measure write latency of %s: %s' %
+                      (path, e))
+        return None
+    finally:
+        # Don't leave the probe on the trainee's USB key, even if the
+        # key is failing.
+        try:
+            if fd is not None:
+                fd.close()
+        except (IOError, OSError):
+            pass
+        try:
+            os.remove(probe_path)
+        except OSError:
+            pass
+    return (write_time - start_time, fsync_time - write_time)
+
+
 def is_landscape():
     return Gdk.Screen.width() > Gdk.Screen.height()
 
@@ -460,14 +784,41 @@ def get_volume_paths():
     return paths
 
 
+def _unescape_mount_field(field):
+    # Spaces, etc. are octal escaped, e.g., \040
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+
+def _read_mountinfo():
+    ''' Map mount points to their devices '''
+    devices = {}
+    try:
+        fd = open(_MOUNTINFO_PATH, 'r')
+        lines = fd.read().split('\n')
+        fd.close()
+    except IOError as e:
+        _logger.error('Could not read %s: %s' % (_MOUNTINFO_PATH, e))
+        return devices
+    for line in lines:
+        # id parent major:minor root mount-point options [optional...] -
+        # fstype source super-options
+        fields = line.split(' - ')
+        if len(fields) != 2:
+            continue
+        mount_point = fields[0].split(' ')
+        source = fields[1].split(' ')
+        if len(mount_point) < 5 or len(source) < 2:
+            continue
+        devices[_unescape_mount_field(mount_point[4])] = \
+            _unescape_mount_field(source[1])
+    return devices
+
+
 def get_device_path(target):
-    # There must be a Gio.VolumeMonitor way of doing this
-    results = subprocess.check_output(['df']).split('\n')
-    for line in results:
-        mount = line.split(' ')
-        if mount[-1] == target:
-            return mount[0]
-    return None
+    ''' Return the device mounted at target (or None) '''
+    # Another key may since have been mounted at the same mount point, so
+    # don't cache: reading mountinfo is cheap.
+    return _read_mountinfo().get(target)
 
 
 def dos_fsck(target):
@@ -551,12 +902,12 @@ def is_fullscreen(activity):
 
 
 def get_starred():
-    dsobjects, nobjects = datastore.find({'keep': '1'})
+    dsobjects, nobjects = _find({'keep': '1'})
     return dsobjects
 
 
 def get_starred_count():
-    dsobjects, nobjects = datastore.find({'keep': '1'})
+    dsobjects, nobjects = _find({'keep': '1'})
     return nobjects
 
 
@@ -753,15 +1104,28 @@ def get_share_scope(activity):
     return False
 
 
+def _get_recent_instances(bundle_id, timestamp=None):
+    ''' The most recently modified instances of an activity. Launching or
+        creating an instance updates its timestamp, so only instances
+        modified since timestamp need to be considered. '''
+    query = {'activity': [bundle_id]}
+    if timestamp is not None:
+        query['timestamp'] = {'start': int(timestamp)}
+    dsobjects, nobjects = _find(
+        query, sorting=['-timestamp'], limit=_RECENT_INSTANCE_LIMIT,
+        properties=_INSTANCE_PROPERTIES)
+    return dsobjects
+
+
 def saw_new_launch(bundle_id, timestamp):
-    for activity in get_activity(bundle_id):
+    for activity in _get_recent_instances(bundle_id, timestamp):
         if get_last_launch_time(activity) > int(timestamp):
             return True
     return False
 
 
 def saw_new_instance(bundle_id, timestamp):
-    for activity in get_activity(bundle_id):
+    for activity in _get_recent_instances(bundle_id, timestamp):
         if get_creation_time(activity) > int(timestamp):
             return True
     return False
@@ -775,24 +1139,76 @@ def get_creation_time(activity):
         return 0
 
 
-def get_last_launch_time(activity):
-    if 'launch-times' in activity.metadata:
-        launch_times = activity.metadata['launch-times'].split(',')
+def _parse_launch_times(launch_times):
+    times = []
+    for launch_time in launch_times.split(','):
         try:
-            return int(launch_times[-1])
-        except Exception, e:
+            times.append(int(launch_time))
+        except ValueError, e:
             _logger.error('Malformed launch times found: %s' % e)
-            return 0
+            times.append(0)
+    return times
+
+
+class _LaunchTimesIndex(object):
+    ''' Parsed launch-times of Journal objects, by object id, so that
+        polling for recent launches does not reparse the metadata. An
+        entry is dropped when the datastore reports that its object was
+        updated or deleted. '''
+
+    def __init__(self):
+        self._launch_times = {}
+        self._signals_connected = False
+
+    def _connect_signals(self):
+        if self._signals_connected:
+            return
+        try:
+            datastore.updated.connect(self.__datastore_changed_cb)
+            datastore.deleted.connect(self.__datastore_changed_cb)
+            self._signals_connected = True
+        except Exception, e:
+            _logger.error('Could not connect to datastore signals: %s' % e)
+
+    def get(self, activity):
+        if not 'launch-times' in activity.metadata:
+            return []
+        launch_times = activity.metadata['launch-times']
+
+        # The running activity is not a Journal entry.
+        object_id = getattr(activity, 'object_id', None)
+        if object_id is None:
+            return _parse_launch_times(launch_times)
+
+        self._connect_signals()
+        if object_id in self._launch_times:
+            # Make sure the entry is not stale (e.g., if we missed a signal)
+            raw, times = self._launch_times[object_id]
+            if raw == launch_times:
+                return times
+        times = _parse_launch_times(launch_times)
+        self._launch_times[object_id] = (launch_times, times)
+        return times
+
+    def __datastore_changed_cb(self, sender, object_id=None, **kwargs):
+        if object_id in self._launch_times:
+            del self._launch_times[object_id]
+
+
+_launch_times_index = _LaunchTimesIndex()
+
+
+def get_last_launch_time(activity):
+    launch_times = _launch_times_index.get(activity)
+    if len(launch_times) > 0:
+        return launch_times[-1]
     else:
         # _logger.error('No launch times found')
         return 0
 
 
 def get_launch_count(activity):
-    if 'launch-times' in activity.metadata:
-        return len(activity.metadata['launch-times'].split(','))
-    else:
-        return 0
+    return len(_launch_times_index.get(activity))
 
 
 def get_colors():
@@ -813,80 +1229,68 @@ def get_favorites():
 
 
 def get_activity(bundle_id):
-    dsobjects, nobjects = datastore.find({'activity': [bundle_id]})
+    dsobjects, nobjects = _find({'activity': [bundle_id]})
     return dsobjects
 
 
 def get_most_recent_instance(bundle_id):
-    dsobjects, nobjects = datastore.find({'activity': [bundle_id]})
     most_recent_time = -1
     most_recent_instance = None
-    for activity in dsobjects:
+    for activity in _get_recent_instances(bundle_id):
         last_launch_time = get_last_launch_time(activity)
         if last_launch_time > most_recent_time:
-            most_recent_time = get_last_launch_time(activity)
+            most_recent_time = last_launch_time
             most_recent_instance = activity
     return most_recent_instance
 
 
+def find_by_mime(mime_types, since=None, properties=None):
+    ''' Yield a JournalEntry for each Journal object of the given mime
+        types, most recently modified first (and, if since is given, only
+        those modified since then). Only metadata is fetched: the file is
+        copied out of the datastore when an entry's file_path is used. '''
+    query = {'mime_type': mime_types}
+    if since is not None:
+        query['timestamp'] = {'start': int(since)}
+    if properties is None:
+        properties = _INSTANCE_PROPERTIES
+    elif not 'uid' in properties:
+        properties = ['uid'] + list(properties)
+    entries, nobjects = _find(
+        query, sorting=['-timestamp'], properties=properties)
+    for entry in entries:
+        yield entry
+
+
 def get_audio():
-    paths = []
-    dsobjects, nobjects = datastore.find({'mime_type': ['audio/ogg']})
-    for dsobject in dsobjects:
-        paths.append(dsobject.file_path)
-    return paths
+    return [entry.file_path for entry in find_by_mime(['audio/ogg'])]
 
 
 def get_image():
-    paths = []
-    dsobjects, nobjects = datastore.find({'mime_type': ['image/png',
-                                                        'image/jpeg']})
-    for dsobject in dsobjects:
-        paths.append(dsobject.file_path)
-    return paths
+    return [entry.file_path for entry in
+            find_by_mime(['image/png', 'image/jpeg'])]
 
 
 def get_png():
-    paths = []
-    dsobjects, nobjects = datastore.find({'mime_type': ['image/png']})
-    for dsobject in dsobjects:
-        paths.append(dsobject.file_path)
-    return paths
+    return [entry.file_path for entry in find_by_mime(['image/png'])]
 
 
 def get_jpg():
-    paths = []
-    dsobjects, nobjects = datastore.find({'mime_type': ['image/jpeg']})
-    for dsobject in dsobjects:
-        paths.append(dsobject.file_path)
-    return paths
+    return [entry.file_path for entry in find_by_mime(['image/jpeg'])]
 
 
 def get_rtf():
-    dsobjects, nobjects = datastore.find({'mime_type': ['text/rtf',
-                                                        'application/rtf']})
-    paths = []
-    for dsobject in dsobjects:
-        paths.append(dsobject.file_path)
-    return paths
+    return [entry.file_path for entry in
+            find_by_mime(['text/rtf', 'application/rtf'])]
 
 
 def get_pdf():
-    dsobjects, nobjects = datastore.find({'mime_type': ['application/pdf']})
-    paths = []
-    for dsobject in dsobjects:
-        paths.append(dsobject.file_path)
-    return paths
+    return [entry.file_path for entry in find_by_mime(['application/pdf'])]
 
 
 def get_odt():
-    dsobjects, nobjects = datastore.find(
-        {'mime_type':
-         ['application/vnd.oasis.opendocument.text']})
-    paths = []
-    for dsobject in dsobjects:
-        paths.append(dsobject.file_path)
-    return paths
+    return [entry.file_path for entry in
+            find_by_mime(['application/vnd.oasis.opendocument.text'])]
 
 
 def get_speak_settings(activity):
@@ -949,16 +1353,364 @@ def select_favorites_view():
     _logger.warning('select_favorites_view is broken')
 
 
+def _read_chunks(fd, size):
+    ''' Read a file in chunks, through mmap if the file is large '''
+    if size < _MMAP_THRESHOLD:
+        while True:
+            chunk = fd.read(_SCAN_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    else:
+        data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for offset in range(0, size, _SCAN_CHUNK_SIZE):
+                yield data[offset:offset + _SCAN_CHUNK_SIZE]
+        finally:
+            data.close()
+
+
+def find_strings(path, strings):
+    ''' Scan a file once for several strings: returns the set of strings
+        found, stopping as soon as all of them have been seen. '''
+    remaining = set(strings)
+    found = set()
+    if len(remaining) == 0:
+        return found
+    # Keep the end of the previous chunk in case a string straddles chunks
+    overlap = max([len(string) for string in remaining]) - 1
+
+    try:
+        with open(path, 'rb') as fd:
+            tail = ''
+            for chunk in _read_chunks(fd, os.fstat(fd.fileno()).st_size):
+                window = tail + chunk
+                for string in list(remaining):
+                    if string in window:
+                        found.add(string)
+                        remaining.remove(string)
+                if len(remaining) == 0:
+                    break
+                if overlap > 0:
+                    tail = window[-overlap:]
+    except (IOError, OSError, ValueError) as e:
+        # _logger.error('Could not read file at %s: %s' % (path, e))
+        pass
+    return found
+
+
 def find_string(path, string):
+    return string in find_strings(path, [string])
+
+
+class _LRUCache(object):
+    ''' A small least-recently-used cache '''
+
+    def __init__(self, size):
+        self._size = size
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        if not key in self._items:
+            return default
+        value = self._items.pop(key)
+        self._items[key] = value
+        return value
+
+    def set(self, key, value):
+        if key in self._items:
+            del self._items[key]
+        elif len(self._items) >= self._size:
+            self._items.popitem(last=False)
+        self._items[key] = value
+
+
+_turtle_blocks_cache = _LRUCache(_TURTLE_CACHE_SIZE)
+
+
+def _parse_turtle_blocks(path):
+    ''' A Turtle Art project is a JSON list of blocks, each of which is
+        [id, name or [name, value], x, y, connections] '''
+    with open(path, 'r') as fd:
+        data = json.load(fd)
+    blocks = set()
+    for block in data:
+        if not isinstance(block, list) or len(block) < 2:
+            continue
+        name = block[1]
+        if isinstance(name, list) and len(name) > 0:
+            name = name[0]
+        if isinstance(name, basestring):
+            blocks.add(name)
+    return frozenset(blocks)
+
+
+def get_turtle_blocks(path):
+    ''' The set of block names used in a Turtle Art project. The project
+        is only parsed again if its modification time or size changes. '''
     try:
-        fd = open(path, 'r')
-    except Exception as e:
-        # _logger.error('Could not open file at %s: %s' % (path, e))
-        return False
-    for line in fd:
-        if string in line:
-            return True
-    return False
+        stats = os.stat(path)
+    except OSError:
+        return frozenset()
+    key = (path, stats.st_mtime, stats.st_size)
+    blocks = _turtle_blocks_cache.get(key)
+    if blocks is None:
+        try:
+            blocks = _parse_turtle_blocks(path)
+        except (IOError, ValueError) as e:
+            _logger.error('Could not parse Turtle Art project %s: %s' %
+                          (path, e))
+            blocks = frozenset()
+        _turtle_blocks_cache.set(key, blocks)
+    return blocks
+
+
+class JournalEntry(object):
+    ''' The metadata of a Journal object. Unlike a DSObject, the file is
+        only copied out of the datastore when file_path is first used and
+        release() removes the copy again. '''
+
+    def __init__(self, object_id, metadata):
+        self.object_id = object_id
+        self.metadata = metadata
+        self._dsobject = None
+
+    def get_file_path(self):
+        if self._dsobject is None:
+            self._dsobject = datastore.get(self.object_id)
+        return self._dsobject.file_path
+
+    file_path = property(get_file_path)
+
+    def release(self):
+        if self._dsobject is not None:
+            self._dsobject.destroy()
+            self._dsobject = None
+
+
+def _get_journal_entries(dsobjects):
+    ''' Copy the metadata out of the DSObjects returned by datastore.find
+        and destroy them, so we don't hold on to them (and their D-Bus
+        signal matches) for the rest of the session. '''
+    entries = []
+    for dsobject in dsobjects:
+        entries.append(JournalEntry(dsobject.object_id,
+                                    dict(dsobject.metadata.get_dictionary())))
+        dsobject.destroy()
+    return entries
+
+
+class DatastoreCache(object):
+    ''' Cache of datastore.find results keyed by the normalized query.
+        Results expire after a short TTL and the cache is cleared whenever
+        the datastore signals that an object was created, updated or
+        deleted. The hit and miss counters show how many D-Bus queries
+        the cache has saved. Results are returned as JournalEntry objects,
+        which are released when they are dropped from the cache. '''
+
+    def __init__(self, ttl=_DATASTORE_CACHE_TTL):
+        self._ttl = ttl
+        self._results = {}
+        self._signals_connected = False
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _connect_signals(self):
+        if self._signals_connected:
+            return
+        try:
+            datastore.created.connect(self.__datastore_changed_cb)
+            datastore.updated.connect(self.__datastore_changed_cb)
+            datastore.deleted.connect(self.__datastore_changed_cb)
+            self._signals_connected = True
+        except Exception, e:
+            # We still have the TTL to keep the results fresh.
+            _logger.error('Could not connect to datastore signals: %s' % e)
+
+    def _get_key(self, query, sorting, limit, properties):
+        normalized = {}
+        for name, value in query.items():
+            if isinstance(value, list):
+                value = sorted(value)
+            normalized[name] = value
+        if properties is not None:
+            properties = sorted(properties)
+        return json.dumps([normalized, sorting, limit, properties],
+                          sort_keys=True)
+
+    def find(self, query, sorting=None, limit=None, properties=None):
+        self._connect_signals()
+
+        key = self._get_key(query, sorting, limit, properties)
+        now = time.time()
+        if key in self._results:
+            expires, entries, nobjects = self._results[key]
+            if now < expires:
+                self.hits += 1
+                return entries, nobjects
+            self._release(key)
+
+        self.misses += 1
+        kwargs = {}
+        if sorting is not None:
+            kwargs['sorting'] = sorting
+        if limit is not None:
+            kwargs['limit'] = limit
+        if properties is not None:
+            kwargs['properties'] = properties
+        dsobjects, nobjects = datastore.find(query, **kwargs)
+        entries = _get_journal_entries(dsobjects)
+        self._results[key] = (now + self._ttl, entries, nobjects)
+        return entries, nobjects
+
+    def _release(self, key):
+        expires, entries, nobjects = self._results.pop(key)
+        for entry in entries:
+            entry.release()
+
+    def invalidate(self):
+        if len(self._results) > 0:
+            self.invalidations += 1
+        for key in self._results.keys():
+            self._release(key)
+
+    def get_stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'entries': len(self._results)}
+
+    def __datastore_changed_cb(self, sender, **kwargs):
+        self.invalidate()
+
+
+_datastore_cache = DatastoreCache()
+
+
+def get_datastore_cache_stats():
+    ''' How much D-Bus traffic is the datastore cache saving us? '''
+    return _datastore_cache.get_stats()
+
+
+def _match_query(metadata, query):
+    ''' Does the metadata match a (simple) datastore query? Lists match any
+        of their values, dicts are {'start': x, 'end': y} ranges. '''
+    for name, value in query.items():
+        if not name in metadata:
+            return False
+        if isinstance(value, dict):
+            try:
+                number = int(metadata[name])
+            except ValueError:
+                return False
+            if 'start' in value and number < int(value['start']):
+                return False
+            if 'end' in value and number > int(value['end']):
+                return False
+        elif isinstance(value, list):
+            if not str(metadata[name]) in [str(v) for v in value]:
+                return False
+        elif str(metadata[name]) != str(value):
+            return False
+    return True
+
+
+class JournalMirror(object):
+    ''' In-memory copy of the Journal metadata the tasks look at. It is
+        loaded with a single query and then kept up to date from the
+        datastore created, updated and deleted signals. If the signals
+        are unavailable, the mirror stays inactive and queries go to the
+        datastore (through the cache). '''
+
+    def __init__(self):
+        self._entries = {}
+        self._active = False
+
+    def load(self):
+        try:
+            datastore.created.connect(self.__datastore_updated_cb)
+            datastore.updated.connect(self.__datastore_updated_cb)
+            datastore.deleted.connect(self.__datastore_deleted_cb)
+        except Exception, e:
+            _logger.error('Could not connect to datastore signals: %s' % e)
+            return False
+        try:
+            dsobjects, nobjects = datastore.find(
+                {}, properties=_INSTANCE_PROPERTIES)
+        except Exception, e:
+            _logger.error('Could not load Journal metadata: %s' % e)
+            return False
+        for entry in _get_journal_entries(dsobjects):
+            self._entries[entry.object_id] = entry
+        _logger.debug('Journal mirror loaded %d entries' % len(self._entries))
+        self._active = True
+        return True
+
+    def is_active(self):
+        return self._active
+
+    def find(self, query, sorting=None, limit=None):
+        entries = [entry for entry in self._entries.values()
+                   if _match_query(entry.metadata, query)]
+        nobjects = len(entries)
+        if sorting is not None and len(sorting) > 0:
+            name = sorting[0].lstrip('+-')
+
+            def sort_key(entry):
+                try:
+                    return int(entry.metadata.get(name, 0))
+                except ValueError:
+                    return 0
+
+            entries.sort(key=sort_key, reverse=sorting[0].startswith('-'))
+        if limit is not None:
+            entries = entries[:limit]
+        return entries, nobjects
+
+    def _remove(self, object_id):
+        entry = self._entries.pop(object_id, None)
+        if entry is not None:
+            entry.release()
+
+    def __datastore_updated_cb(self, sender, object_id=None, **kwargs):
+        if not self._active or object_id is None:
+            return
+        self._remove(object_id)
+        try:
+            dsobjects, nobjects = datastore.find(
+                {'uid': object_id}, properties=_INSTANCE_PROPERTIES)
+        except Exception, e:
+            _logger.error('Could not update Journal mirror: %s' % e)
+            return
+        for entry in _get_journal_entries(dsobjects):
+            self._entries[entry.object_id] = entry
+
+    def __datastore_deleted_cb(self, sender, object_id=None, **kwargs):
+        if self._active:
+            self._remove(object_id)
+
+
+_journal_mirror = None
+
+
+def get_journal_mirror():
+    global _journal_mirror
+    if _journal_mirror is None:
+        _journal_mirror = JournalMirror()
+        _journal_mirror.load()
+    return _journal_mirror
+
+
+def _find(query, sorting=None, limit=None, properties=None):
+    ''' Answer a query from the Journal mirror if we can, otherwise ask
+        the datastore. '''
+    if properties is None or set(properties) <= set(_INSTANCE_PROPERTIES):
+        mirror = get_journal_mirror()
+        if mirror.is_active():
+            return mirror.find(query, sorting=sorting, limit=limit)
+    return _datastore_cache.find(query, sorting=sorting, limit=limit,
+                                 properties=properties)
 
 
 class DeviceModel(GObject.GObject):
@@ -1066,19 +1818,29 @@ def nm_status():
 
 
 class Completer(object):
+    ''' Prefix completion over the options sorted by their lowercase keys:
+        the matches are found with a binary search, so returning the first
+        k of them is O(log n + k). '''
 
     def __init__(self, options):
-        self.options = sorted(options)
+        self.options = sorted([option for option in options if option],
+                              key=lambda option: option.lower())
+        self._keys = [option.lower() for option in self.options]
+        self.matches = []
 
-    def complete(self, text, state):
+    def complete(self, text, state, limit=None):
         if state == 0:  # on first trigger, build possible matches
             if text:  # cache matches (entries that start with entered text)
-                self.matches = [s for s in self.options
-                                if s and s.lower().startswith(text.lower())]
+                prefix = text.lower()
+                i = bisect.bisect_left(self._keys, prefix)
+                self.matches = []
+                while i < len(self._keys) and \
+                        self._keys[i].startswith(prefix):
+                    if limit is not None and len(self.matches) >= limit:
+                        break
+                    self.matches.append(self.options[i])
+                    i += 1
             else:  # no text entered, all matches possible
-                self.matches = self.options[:]
+                self.matches = self.options[:limit]
 
-        try:
-            return self.matches
-        except IndexError:
-            return None
+        return self.matches
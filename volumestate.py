@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014, Sugarlabs
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+import os
+
+from gi.repository import Gio
+from gi.repository import GObject
+
+import utils
+
+import logging
+_logger = logging.getLogger('training-activity-volumestate')
+
+# A single insertion often fires several mount events in a row.
+_MOUNT_EVENT_DELAY = 500  # ms
+
+
+class VolumeState(GObject.GObject):
+    ''' Cached model of the mounted volumes and the training data on them.
+        The model is only updated from the volume monitor mount-added and
+        mount-removed signals (or an explicit refresh), so that checking
+        the volumes before each task does not rescan the filesystem.
+        Mount events are debounced and 'changed' is only emitted when the
+        set of mounted volumes is different from the one in the model. '''
+
+    __gsignals__ = {
+        'changed': (GObject.SignalFlags.RUN_FIRST, None, ([])),
+    }
+
+    def __init__(self, sugar_path):
+        GObject.GObject.__init__(self)
+
+        self._sugar_path = sugar_path
+        self._paths = []
+        self._volumes = {}
+        self._mount_event_timeout_id = None
+
+        self._volume_monitor = Gio.VolumeMonitor.get()
+        for mount in self._volume_monitor.get_mounts():
+            self._add_mount(mount)
+
+        self._mount_added_id = self._volume_monitor.connect(
+            'mount-added', self.__mount_added_cb)
+        self._mount_removed_id = self._volume_monitor.connect(
+            'mount-removed', self.__mount_removed_cb)
+
+    def _add_mount(self, mount):
+        self._add_path(mount.get_root().get_path())
+
+    def _add_path(self, path):
+        if path is None or path in self._volumes:
+            return
+        self._paths.append(path)
+        self._volumes[path] = {
+            'basename': os.path.basename(path),
+            'files': utils.look_for_training_data(path),
+            'sugar_path': self._sugar_path,
+            'usb_path': path}
+        _logger.debug(self._volumes[path])
+
+    def _remove_path(self, path):
+        if path in self._volumes:
+            self._paths.remove(path)
+            del self._volumes[path]
+
+    def _update_mounts(self):
+        ''' Diff the mounted volumes against the model, only scanning the
+            volumes that were added. Returns True if anything changed. '''
+        paths = []
+        for mount in self._volume_monitor.get_mounts():
+            path = mount.get_root().get_path()
+            if path is not None:
+                paths.append(path)
+
+        removed = [path for path in self._paths if not path in paths]
+        added = [path for path in paths if not path in self._volumes]
+        for path in removed:
+            self._remove_path(path)
+        for path in added:
+            self._add_path(path)
+
+        if len(added) > 0 or len(removed) > 0:
+            _logger.debug('volumes added: %s removed: %s' % (added, removed))
+            return True
+        return False
+
+    def refresh(self, path=None):
+        ''' Rescan the training data on one (or every) volume, e.g., after
+            the files have been renamed. '''
+        if path is None:
+            paths = self._paths
+        elif path in self._volumes:
+            paths = [path]
+        else:
+            paths = []
+        for path in paths:
+            self._volumes[path]['files'] = utils.look_for_training_data(path)
+
+    def get_files(self, path):
+        ''' Return the training-data files found on a volume '''
+        if path in self._volumes:
+            return self._volumes[path]['files'][:]
+        return []
+
+    def is_alive(self):
+        ''' A cheap check that the volumes we know about are still mounted '''
+        for path in self._paths:
+            if not os.path.isdir(path):
+                _logger.error('Volume %s is no longer available' % path)
+                return False
+        return True
+
+    def get_volume_data(self):
+        ''' Return a copy of the volume data, in mount order '''
+        volume_data = []
+        for path in self._paths:
+            volume = dict(self._volumes[path])
+            volume['files'] = volume['files'][:]
+            volume_data.append(volume)
+        return volume_data
+
+    def shutdown(self):
+        ''' Stop tracking mount events '''
+        if self._mount_event_timeout_id is not None:
+            GObject.source_remove(self._mount_event_timeout_id)
+            self._mount_event_timeout_id = None
+        self._volume_monitor.disconnect(self._mount_added_id)
+        self._volume_monitor.disconnect(self._mount_removed_id)
+
+    def _queue_update(self):
+        # Restart the timer so a burst of mount events is handled once.
+        if self._mount_event_timeout_id is not None:
+            GObject.source_remove(self._mount_event_timeout_id)
+        self._mount_event_timeout_id = GObject.timeout_add(
+            _MOUNT_EVENT_DELAY, self.__mount_event_timeout_cb)
+
+    def __mount_event_timeout_cb(self):
+        self._mount_event_timeout_id = None
+        if self._update_mounts():
+            self.emit('changed')
+        return False
+
+    def __mount_added_cb(self, volume_monitor, mount):
+        _logger.debug('mount added')
+        self._queue_update()
+
+    def __mount_removed_cb(self, volume_monitor, mount):
+        _logger.debug('mount removed')
+        self._queue_update()